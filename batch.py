@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import instrument
+import ips
+import journal
+import patch
+
+# This runs the full Voyager patch over a whole batch of roms at once,
+# spread out over a pool of worker processes. Usage:
+#
+#   python batch.py <input folder or manifest> <output folder>
+#
+# The input can either be a folder (every .smc/.sfc file in it gets
+# patched) or a manifest, which is just a text file listing one input
+# rom per line. Blank lines and lines starting with # are skipped.
+# Each patched rom is saved in the output folder under the same file
+# name as its input (so no two inputs can share a file name). With
+# --format ips or --format bps, only a patch against the input rom is
+# saved instead (with that extension).
+# With --profile <folder>, every rom's step timings are saved in that
+# folder (see instrument.py), along with a summary.json of the totals
+# across the whole batch.
+# With --journal <folder>, a journal of every change made to each rom
+# (see journal.py) is saved in that folder.
+# With --pipeline, the jobs are handed out through an asyncio queue
+# instead (see run_pipeline).
+# The IPS patches are taken from the bundled ips folder, unless another
+# folder is given with --patchpath.
+
+ROM_EXTENSIONS = (".smc", ".sfc")
+
+# Returns the list of input roms named by a folder or a manifest file,
+# in a stable (sorted or manifest) order.
+def find_roms(source):
+ if os.path.isdir(source):
+  names = sorted(os.listdir(source))
+  return [os.path.join(source, name) for name in names if name.lower().endswith(ROM_EXTENSIONS)]
+ roms = []
+ with open(source) as manifest:
+  for line in manifest:
+   line = line.strip()
+   if len(line) > 0 and not line.startswith("#"):
+    roms.append(line)
+ return roms
+
+# Patches a single rom inside a worker. Every job builds its own FF4Rom
+# from scratch, so nothing carries over from one job to the next and
+# each output matches what patch.py would produce for that rom alone.
+# Errors are reported back instead of raised so that one bad rom
+# doesn't take down the rest of the batch.
+def patch_job(job):
+ inputfile, outputfile, patchpath, profiledir, trace, journaldir = job
+ profiler = None
+ if profiledir is not None:
+  profiler = instrument.Profiler(inputfile)
+ changes = None
+ if journaldir is not None:
+  changes = journal.Journal(inputfile)
+ try:
+  patch.patch_rom(inputfile, outputfile, patchpath, profiler = profiler, journal = changes)
+ except Exception as error:
+  return (inputfile, False, "{}: {}".format(type(error).__name__, error))
+ finally:
+  if profiler is not None:
+   name = os.path.join(profiledir, os.path.basename(inputfile))
+   profiler.save(name + ".json")
+   if trace:
+    profiler.save(name + ".trace.json")
+  if changes is not None:
+   changes.save(os.path.join(journaldir, os.path.basename(inputfile) + ".journal.json"))
+ return (inputfile, True, outputfile)
+
+# Patches every rom in the list and returns one (input, ok, detail)
+# result per rom, in the same order as the inputs. At most "inflight"
+# jobs are handed to the pool at any time so that a huge batch doesn't
+# queue up thousands of jobs (and their results) in memory at once.
+def run_batch(inputs, outputdir, workers = None, inflight = None, report = print, format = "rom", profiledir = None, trace = False, journaldir = None, patchpath = ips.BUNDLED_FOLDER):
+ if workers is None:
+  workers = os.cpu_count() or 1
+ if inflight is None:
+  inflight = workers * 2
+ os.makedirs(outputdir, exist_ok = True)
+ if profiledir is not None:
+  os.makedirs(profiledir, exist_ok = True)
+ if journaldir is not None:
+  os.makedirs(journaldir, exist_ok = True)
+ jobs = [(path, output_name(path, outputdir, format), patchpath, profiledir, trace, journaldir) for path in inputs]
+ check_outputs([job[1] for job in jobs])
+ results = [None] * len(jobs)
+ with ProcessPoolExecutor(workers) as pool:
+  pending = {}
+  position = 0
+  while position < len(jobs) or len(pending) > 0:
+   while position < len(jobs) and len(pending) < inflight:
+    pending[pool.submit(patch_job, jobs[position])] = position
+    position += 1
+   done, _ = wait(pending, return_when = FIRST_COMPLETED)
+   for future in done:
+    index = pending.pop(future)
+    results[index] = future.result()
+    if report is not None:
+     report(format_result(results[index]))
+ if profiledir is not None:
+  with open(os.path.join(profiledir, "summary.json"), "w") as file:
+   json.dump(instrument.aggregate_folder(profiledir), file, indent = 1)
+ return results
+
+# The same batch run as an asyncio pipeline: a feeder hands the jobs
+# out through a bounded queue, and one patcher per worker process takes
+# them off it and runs patch_job. The workers are only given the file
+# names and do the reading and writing themselves, so each rom goes
+# through the disk once each way and never gets copied from one process
+# to another. The queue keeps at most "readahead" jobs waiting on top of
+# the ones being patched, however big the batch is.
+async def run_pipeline(inputs, outputdir, workers = None, readahead = 2, report = print, format = "rom", patchpath = ips.BUNDLED_FOLDER):
+ if workers is None:
+  workers = os.cpu_count() or 1
+ os.makedirs(outputdir, exist_ok = True)
+ loop = asyncio.get_running_loop()
+ jobs = [(path, output_name(path, outputdir, format), patchpath, None, False, None) for path in inputs]
+ check_outputs([job[1] for job in jobs])
+ results = [None] * len(jobs)
+ queue = asyncio.Queue(readahead)
+
+ async def feeder():
+  for index in range(len(jobs)):
+   await queue.put(index)
+  for worker in range(workers):
+   await queue.put(None)
+
+ # patch_job reports its own errors, so this only catches the pool
+ # itself failing (say, a worker getting killed).
+ async def patcher():
+  while True:
+   index = await queue.get()
+   if index is None:
+    return
+   try:
+    results[index] = await loop.run_in_executor(pool, patch_job, jobs[index])
+   except Exception as error:
+    results[index] = (jobs[index][0], False, "{}: {}".format(type(error).__name__, error))
+   if report is not None:
+    report(format_result(results[index]))
+
+ with ProcessPoolExecutor(workers) as pool:
+  await asyncio.gather(feeder(), *[patcher() for worker in range(workers)])
+ return results
+
+def output_name(inputfile, outputdir, format):
+ name = os.path.basename(inputfile)
+ if format != "rom":
+  name = os.path.splitext(name)[0] + "." + format
+ return os.path.join(outputdir, name)
+
+# Outputs are named after their inputs' file names only, so two inputs
+# from different folders (a/fe.smc and b/fe.smc) would overwrite each
+# other's output, profile and journal. That's caught before anything
+# gets patched.
+def check_outputs(outputfiles):
+ seen = set()
+ duplicates = []
+ for outputfile in outputfiles:
+  if outputfile in seen and outputfile not in duplicates:
+   duplicates.append(outputfile)
+  seen.add(outputfile)
+ if len(duplicates) > 0:
+  raise ValueError("More than one input would be saved as: {}".format(", ".join(duplicates)))
+
+def format_result(result):
+ inputfile, ok, detail = result
+ if ok:
+  return "OK     {} -> {}".format(inputfile, detail)
+ return "FAILED {} ({})".format(inputfile, detail)
+
+if __name__ == "__main__":
+ parser = argparse.ArgumentParser(description = "Patch a batch of Free Enterprise roms with Voyager.")
+ parser.add_argument("source", help = "folder of roms, or a manifest listing one rom per line")
+ parser.add_argument("outputdir", help = "folder to save the patched roms in")
+ parser.add_argument("--workers", type = int, default = None, help = "number of worker processes (default: one per CPU)")
+ parser.add_argument("--inflight", type = int, default = None, help = "maximum number of jobs queued at once (default: twice the workers)")
+ parser.add_argument("--format", choices = ["rom", "ips", "bps"], default = "rom", help = "save full roms, or only IPS/BPS patches of the changes")
+ parser.add_argument("--profile", default = None, help = "folder to save per-rom timings and a batch summary in")
+ parser.add_argument("--trace", action = "store_true", help = "also save each rom's timings as a Chrome trace")
+ parser.add_argument("--journal", default = None, help = "folder to save a journal of each rom's changes in")
+ parser.add_argument("--patchpath", default = ips.BUNDLED_FOLDER, help = "folder holding the IPS patches")
+ parser.add_argument("--pipeline", action = "store_true", help = "hand the jobs out through an asyncio queue")
+ parser.add_argument("--read-ahead", type = int, default = 2, help = "with --pipeline, how many roms can wait to be patched")
+ args = parser.parse_args()
+
+ if args.pipeline and (args.profile is not None or args.journal is not None):
+  parser.error("--profile and --journal can't be used with --pipeline")
+ try:
+  if args.pipeline:
+   results = asyncio.run(run_pipeline(find_roms(args.source), args.outputdir, args.workers, args.read_ahead, format = args.format, patchpath = args.patchpath))
+  else:
+   results = run_batch(find_roms(args.source), args.outputdir, args.workers, args.inflight, format = args.format, profiledir = args.profile, trace = args.trace, journaldir = args.journal, patchpath = args.patchpath)
+ except ValueError as error:
+  parser.error(str(error))
+ failures = [result for result in results if not result[1]]
+ print("{} patched, {} failed".format(len(results) - len(failures), len(failures)))
+ if len(failures) > 0:
+  raise SystemExit(1)
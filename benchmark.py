@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import delta
+import fixtures
+import ips
+import patch
+import pipeline
+import voyager
+
+# Times the Voyager pipeline on a synthetic rom (see fixtures.py):
+#  * each customize step on its own
+#  * reading and writing the item descriptions
+#  * building IPS and BPS patches of the result
+#  * patch.py from start to finish
+#
+# Every run is appended as one JSON line to the history file, and the
+# results are compared with the previous run so that anything that got
+# noticeably slower stands out. Usage:
+#
+#   python benchmark.py [--repeat N] [--history FILE]
+
+HISTORY = "benchmark-history.jsonl"
+
+# How much slower (as a fraction) a benchmark has to get before it's
+# flagged as a regression.
+THRESHOLD = 0.2
+
+# Runs "function" the given number of times, calling "setup" (untimed)
+# before each run and passing its result in, and returns the timings.
+def timeit(function, setup = None, repeat = 5):
+ timings = []
+ for run in range(repeat):
+  argument = setup() if setup is not None else None
+  start = time.perf_counter()
+  function(argument)
+  timings.append(time.perf_counter() - start)
+ return timings
+
+def run_benchmarks(romfile, repeat):
+ with open(romfile, "rb") as file:
+  source = file.read()
+ results = {}
+
+ def loaded():
+  return patch.load_rom(romfile)
+
+ def prepared(step):
+  def setup():
+   ff4 = loaded()
+   steps = pipeline.plan([step.name])
+   pipeline.prepare(ff4, steps, ips.BUNDLED_FOLDER)
+   return ff4
+  return setup
+
+ results["read"] = timeit(lambda ff4: loaded(), repeat = repeat)
+ for step in pipeline.STEPS:
+  results[step.name] = timeit(lambda ff4, step = step: step.run(ff4, ips.BUNDLED_FOLDER), prepared(step), repeat)
+
+ results["read_item_descriptions"] = timeit(voyager.read_item_descriptions, loaded, repeat)
+
+ def renamed():
+  ff4 = loaded()
+  voyager.read_item_descriptions(ff4)
+  voyager.rename_spells(ff4)
+  return ff4
+ results["write_item_descriptions"] = timeit(voyager.write_item_descriptions, renamed, repeat)
+
+ with tempfile.TemporaryDirectory() as folder:
+  output = os.path.join(folder, "out.smc")
+  results["patch_rom"] = timeit(lambda ignored: patch.patch_rom(romfile, output, ips.BUNDLED_FOLDER, use_cache = False), repeat = repeat)
+  with open(output, "rb") as file:
+   result = file.read()
+
+ results["delta_diff"] = timeit(lambda ignored: delta.diff(source, result), repeat = repeat)
+ results["make_ips"] = timeit(lambda ignored: ips.make_ips(source, result), repeat = repeat)
+ results["make_bps"] = timeit(lambda ignored: ips.make_bps(source, result), repeat = repeat)
+
+ return {name: {"min": min(timings), "median": statistics.median(timings)} for name, timings in results.items()}
+
+def git_commit():
+ try:
+  return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+ except OSError:
+  return ""
+
+def last_run(history):
+ if not os.path.exists(history):
+  return None
+ last = None
+ with open(history) as file:
+  for line in file:
+   if len(line.strip()) > 0:
+    last = json.loads(line)
+ return last
+
+# Lists the benchmarks whose best time got more than THRESHOLD slower
+# since the previous run.
+def regressions(previous, current, threshold = THRESHOLD):
+ slower = []
+ if previous is None:
+  return slower
+ for name, timing in current["results"].items():
+  if name in previous["results"]:
+   before = previous["results"][name]["min"]
+   if before > 0 and timing["min"] > before * (1 + threshold):
+    slower.append((name, before, timing["min"]))
+ return slower
+
+if __name__ == "__main__":
+ parser = argparse.ArgumentParser(description = "Benchmark Voyager on a synthetic rom.")
+ parser.add_argument("--repeat", type = int, default = 5, help = "times to run each benchmark")
+ parser.add_argument("--seed", type = int, default = 0, help = "seed for the synthetic rom")
+ parser.add_argument("--history", default = HISTORY, help = "file to append the results to")
+ args = parser.parse_args()
+
+ with tempfile.TemporaryDirectory() as folder:
+  romfile = fixtures.write_rom(os.path.join(folder, "fixture.smc"), args.seed)
+  fixtures.check_rom(romfile)
+  results = run_benchmarks(romfile, args.repeat)
+
+ run = {
+  "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+  "commit": git_commit(),
+  "python": platform.python_version(),
+  "seed": args.seed,
+  "repeat": args.repeat,
+  "results": results
+ }
+ previous = last_run(args.history)
+ with open(args.history, "a") as file:
+  file.write(json.dumps(run) + "\n")
+
+ for name, timing in results.items():
+  print("{:<28} {:9.2f} ms  (median {:.2f} ms)".format(name, timing["min"] * 1000, timing["median"] * 1000))
+ for name, before, after in regressions(previous, run):
+  print("REGRESSION: {} went from {:.2f} ms to {:.2f} ms".format(name, before * 1000, after * 1000))
@@ -0,0 +1,137 @@
+import hashlib
+import os
+
+import delta
+
+# A local cache of finished patch results. Patching the same input rom
+# with the same steps always gives the same output, so the result is
+# stored as the list of bytes that changed, keyed by a hash of the
+# input rom, the Voyager and gamingway code, the IPS patches and the
+# steps that were run. A repeat request then just applies the saved
+# changes to the input without parsing the rom at all.
+#
+# The changes are saved in delta.py's own format rather than pickled,
+# since the folder can be shared and loading a pickle runs whatever
+# code is in it.
+#
+# Once the cache grows past MAX_SIZE bytes, the least recently used
+# results are thrown out. That covers everything in the results folder,
+# including the event scans eventdecoder.py keeps there.
+
+CACHE_DIR = os.environ.get("VOYAGER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "voyager"))
+RESULTS_DIR = os.path.join(CACHE_DIR, "results")
+MAX_SIZE = int(os.environ.get("VOYAGER_CACHE_SIZE", 256 * 1024 * 1024))
+
+SOURCE_FILES = ["voyager.py", "pipeline.py", "patch.py", "ips.py", "delta.py", "romimage.py", "grid.py", "dungeon.py"]
+
+def rom_hash(data):
+ return hashlib.sha1(data).hexdigest()
+
+# Gamingway does all the reading and writing of the rom's sections, so
+# a new version of it can change the output as much as a new Voyager.
+# Its source only gets hashed once per process, since the gamingway a
+# process has loaded can't change under it anyway.
+gamingway_hash = None
+
+def gamingway_version():
+ global gamingway_hash
+ if gamingway_hash is None:
+  digest = hashlib.sha1()
+  try:
+   import gamingway
+  except ImportError:
+   gamingway = None
+  if gamingway is not None:
+   digest.update(str(getattr(gamingway, "__version__", "")).encode())
+   folder = os.path.dirname(os.path.abspath(gamingway.__file__))
+   for name in sorted(os.listdir(folder)):
+    if name.endswith(".py"):
+     digest.update(name.encode())
+     with open(os.path.join(folder, name), "rb") as file:
+      digest.update(file.read())
+  gamingway_hash = digest.hexdigest()
+ return gamingway_hash
+
+# Hashes everything besides the input rom that can change the output:
+# the Voyager and gamingway code and the IPS patches Voyager applies.
+def code_version(patchpath):
+ digest = hashlib.sha1()
+ digest.update(gamingway_version().encode())
+ here = os.path.dirname(os.path.abspath(__file__))
+ for name in SOURCE_FILES:
+  with open(os.path.join(here, name), "rb") as file:
+   digest.update(file.read())
+ if os.path.isdir(patchpath):
+  for name in sorted(os.listdir(patchpath)):
+   if name.lower().endswith(".ips"):
+    digest.update(name.encode())
+    with open(os.path.join(patchpath, name), "rb") as file:
+     digest.update(file.read())
+ return digest.hexdigest()
+
+def result_key(source, steps, patchpath):
+ digest = hashlib.sha1()
+ digest.update(rom_hash(source).encode())
+ digest.update(code_version(patchpath).encode())
+ digest.update("\n".join(sorted(steps)).encode())
+ return digest.hexdigest()
+
+def result_file(key):
+ return os.path.join(RESULTS_DIR, key + ".delta")
+
+# Patches "data" (the input rom, as a bytearray or RomImage) in place
+# with the cached result for the given key and returns it, or returns
+# None if it isn't cached. A hit counts as a use for the LRU eviction.
+# Whatever goes wrong reading the entry, the rom just gets patched the
+# normal way.
+def lookup(key, data):
+ filename = result_file(key)
+ try:
+  with open(filename, "rb") as file:
+   runs, size = delta.decode(file.read())
+ except Exception:
+  return None
+
+ # Another process may have evicted the file since; the result we
+ # loaded is still good.
+ try:
+  os.utime(filename)
+ except OSError:
+  pass
+ return delta.apply_in_place(data, runs, size)
+
+# Saves a result as the size of the output rom and the runs of bytes
+# that differ from the input (see delta.py).
+def store(key, size, runs):
+ os.makedirs(RESULTS_DIR, exist_ok = True)
+ filename = result_file(key)
+ temporary = "{}.{}.tmp".format(filename, os.getpid())
+ with open(temporary, "wb") as file:
+  file.write(delta.encode(runs, size))
+ os.replace(temporary, filename)
+ evict()
+
+# Removes the least recently used results until the cache fits in
+# MAX_SIZE again.
+def evict(limit = None):
+ if limit is None:
+  limit = MAX_SIZE
+ entries = []
+ total = 0
+ for entry in os.scandir(RESULTS_DIR):
+  if not entry.name.endswith(".tmp"):
+   try:
+    stat = entry.stat()
+   except OSError:
+    continue
+   entries.append((stat.st_mtime, stat.st_size, entry.path))
+   total += stat.st_size
+ entries.sort()
+ for _, size, path in entries:
+  if total <= limit:
+   break
+  try:
+   os.remove(path)
+  except OSError:
+   pass
+  total -= size
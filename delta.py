@@ -0,0 +1,92 @@
+import struct
+
+import numpy
+
+# Helpers for working with the raw differences between two roms, stored
+# as a list of (offset, bytes) runs plus the size of the new rom.
+
+# Returns the (start, end) ranges of bytes that differ between the two
+# roms, merging ranges less than "gap" bytes apart. Anything past the
+# end of the shorter rom counts as changed. The comparison is done on
+# whole NumPy arrays, so even a full-size pair of roms takes a few
+# milliseconds.
+def ranges(old, new, gap = 0):
+ old = numpy.frombuffer(old, dtype = numpy.uint8)
+ new = numpy.frombuffer(new, dtype = numpy.uint8)
+ common = min(len(old), len(new))
+ changed = numpy.flatnonzero(old[:common] != new[:common])
+ if len(old) != len(new):
+  changed = numpy.concatenate((changed, numpy.arange(common, max(len(old), len(new)))))
+ if len(changed) == 0:
+  return []
+
+ # Two changed bytes belong to the same range unless more than "gap"
+ # unchanged bytes lie between them.
+ breaks = numpy.flatnonzero(numpy.diff(changed) > gap + 1)
+ starts = changed[numpy.concatenate(([0], breaks + 1))]
+ ends = changed[numpy.concatenate((breaks, [len(changed) - 1]))] + 1
+ return list(zip(starts.tolist(), ends.tolist()))
+
+# Returns the runs of bytes in "new" that differ from "old". Anything
+# past the end of "old" counts as changed.
+def diff(old, new):
+ runs = []
+ for start, end in ranges(old, new):
+  end = min(end, len(new))
+  if start < end:
+   runs.append((start, bytes(new[start:end])))
+ return runs
+
+# Applies a list of runs to a copy of "old" and returns the new rom.
+def apply(old, runs, size):
+ return apply_in_place(bytearray(old), runs, size)
+
+# Applies a list of runs directly to "data", which can be a bytearray or
+# anything that acts like one (such as a RomImage).
+def apply_in_place(data, runs, size):
+ if len(data) > size:
+  del data[size:]
+ elif len(data) < size:
+  data.extend(bytes(size - len(data)))
+ for offset, chunk in runs:
+  data[offset:offset + len(chunk)] = chunk
+ return data
+
+# Runs are saved as a small binary format: a header holding the size of
+# the new rom and the number of runs, then each run as its offset, its
+# length and its bytes. Unlike a pickle, reading one back can't run any
+# code, so it's safe to load files someone else wrote.
+MAGIC = b"VYD1"
+HEADER = struct.Struct("<4sQI")
+RUN = struct.Struct("<QI")
+
+def encode(runs, size):
+ parts = [HEADER.pack(MAGIC, size, len(runs))]
+ for offset, chunk in runs:
+  parts.append(RUN.pack(offset, len(chunk)))
+  parts.append(bytes(chunk))
+ return b"".join(parts)
+
+# Returns (runs, size), or raises ValueError if "raw" isn't a complete,
+# consistent set of runs.
+def decode(raw):
+ if len(raw) < HEADER.size:
+  raise ValueError("Delta is too short.")
+ magic, size, count = HEADER.unpack_from(raw, 0)
+ if magic != MAGIC:
+  raise ValueError("Not a delta.")
+ runs = []
+ position = HEADER.size
+ for index in range(count):
+  if position + RUN.size > len(raw):
+   raise ValueError("Delta ends in the middle of a run.")
+  offset, length = RUN.unpack_from(raw, position)
+  position += RUN.size
+  chunk = bytes(raw[position:position + length])
+  if len(chunk) < length or offset + length > size:
+   raise ValueError("Delta run at {:X} doesn't fit.".format(offset))
+  runs.append((offset, chunk))
+  position += length
+ if position != len(raw):
+  raise ValueError("Delta has trailing data.")
+ return runs, size
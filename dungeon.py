@@ -0,0 +1,251 @@
+import hashlib
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+# Procedural dungeon layouts for map procgen (see voyager.procgen).
+#
+# A layout is a handful of rectangular rooms joined by L-shaped
+# corridors, with a few rocks scattered around the rooms as obstacles
+# and the chests placed along the room walls. The anchors are the spots
+# that have to stay where they are (stairs, exits and other triggers):
+# each one keeps its original tile and gets a corridor of its own, so
+# it's always part of the dungeon.
+#
+# Since rocks and chests can still block the way, every candidate is
+# checked with a flood fill: all the anchors have to be reachable from
+# the first one, and every chest has to be next to a reachable floor
+# tile. The flood fill works on whole boolean arrays at once, so it's
+# cheap enough to throw away and regenerate candidates by the thousand.
+#
+# search() goes one further and generates a whole batch of layouts
+# across a process pool, scores them and keeps the best one.
+
+# How many rooms a layout gets, and their size range (width, height).
+ROOMS = (4, 8)
+ROOM_WIDTH = (3, 7)
+ROOM_HEIGHT = (3, 6)
+
+# The fraction of room tiles that get turned into rocks.
+ROCK_DENSITY = 0.05
+
+# How much each measure counts towards a layout's score (see score()).
+#  * path - average walking distance from the start to each chest
+#  * spread - average distance between two chests
+#  * dead_ends - number of floor tiles with only one way out
+WEIGHTS = {
+ "path": 1.0,
+ "spread": 0.5,
+ "dead_ends": -2.0
+}
+
+class Layout:
+ def __init__(self, tiles, floor, reached, chests, start):
+  self.tiles = tiles
+  self.floor = floor
+  self.reached = reached
+  self.chests = chests
+  self.start = start
+
+# Returns the mask grown by one tile in each of the four directions.
+def dilate(mask):
+ grown = mask.copy()
+ grown[1:, :] |= mask[:-1, :]
+ grown[:-1, :] |= mask[1:, :]
+ grown[:, 1:] |= mask[:, :-1]
+ grown[:, :-1] |= mask[:, 1:]
+ return grown
+
+# Returns the mask of walkable tiles that can be reached from "start",
+# an (x, y) position.
+def flood(walkable, start):
+ x, y = start
+ reached = numpy.zeros_like(walkable)
+ if not walkable[y, x]:
+  return reached
+ reached[y, x] = True
+ count = 1
+ while True:
+  reached = dilate(reached) & walkable
+  grown = numpy.count_nonzero(reached)
+  if grown == count:
+   return reached
+  count = grown
+
+# Like flood, but returns how many steps away from "start" each tile
+# is, with -1 for the ones that can't be reached.
+def distances(walkable, start):
+ x, y = start
+ result = numpy.full(walkable.shape, -1, dtype = numpy.int32)
+ if not walkable[y, x]:
+  return result
+ reached = numpy.zeros_like(walkable)
+ reached[y, x] = True
+ frontier = reached
+ step = 0
+ while frontier.any():
+  result[frontier] = step
+  grown = dilate(reached) & walkable
+  frontier = grown & ~reached
+  reached = grown
+  step += 1
+ return result
+
+# Carves out the rooms and corridors, returning the masks of both.
+# Every anchor gets connected along with the rooms.
+def carve(shape, rng, anchors):
+ height, width = shape
+ rooms = numpy.zeros(shape, dtype = bool)
+ corridors = numpy.zeros(shape, dtype = bool)
+ centres = list(anchors)
+ for room in range(rng.randint(*ROOMS)):
+  w = min(rng.randint(*ROOM_WIDTH), width - 2)
+  h = min(rng.randint(*ROOM_HEIGHT), height - 2)
+  x = rng.randint(1, width - w - 1)
+  y = rng.randint(1, height - h - 1)
+  rooms[y:y + h, x:x + w] = True
+  centres.append((x + w // 2, y + h // 2))
+ for index in range(1, len(centres)):
+  x1, y1 = centres[index]
+  x2, y2 = centres[rng.randrange(index)]
+  if rng.random() < 0.5:
+   corridors[y1, min(x1, x2):max(x1, x2) + 1] = True
+   corridors[min(y1, y2):max(y1, y2) + 1, x2] = True
+  else:
+   corridors[min(y1, y2):max(y1, y2) + 1, x1] = True
+   corridors[y2, min(x1, x2):max(x1, x2) + 1] = True
+ return rooms, corridors
+
+# Makes one candidate layout, or returns None if it doesn't pass the
+# reachability check.
+#  * shape - (height, width) of the tilemap
+#  * chests - how many chests to place
+#  * anchors - {(x, y): tile} for the spots that have to stay put
+#  * tiles - {"wall", "floor", "rock", "chest"} tile numbers
+def candidate(shape, rng, chests, anchors, tiles):
+ rooms, corridors = carve(shape, rng, anchors)
+ floor = rooms | corridors
+ fixed = numpy.zeros(shape, dtype = bool)
+ for x, y in anchors:
+  fixed[y, x] = True
+
+ # Rocks and chests only go in the rooms, since a single one would cut
+ # a corridor in two.
+ open_floor = rooms & ~corridors & ~fixed
+ spots = numpy.flatnonzero(open_floor)
+
+ rocks = numpy.zeros(shape, dtype = bool)
+ count = int(len(spots) * ROCK_DENSITY)
+ if count > 0:
+  rocks.flat[rng.sample(spots.tolist(), count)] = True
+
+ # Chests go against the walls, so they don't end up in the middle of
+ # a room.
+ edges = numpy.flatnonzero(open_floor & ~rocks & dilate(~floor)).tolist()
+ if len(edges) < chests:
+  return None
+ chest_mask = numpy.zeros(shape, dtype = bool)
+ chest_mask.flat[rng.sample(edges, chests)] = True
+
+ walkable = floor & ~rocks & ~chest_mask
+ start = next(iter(anchors), None)
+ if start is None:
+  ys, xs = numpy.nonzero(walkable)
+  if len(xs) == 0:
+   return None
+  start = (int(xs[0]), int(ys[0]))
+ reached = flood(walkable, start)
+ if not reached[fixed].all() or not dilate(reached)[chest_mask].all():
+  return None
+
+ result = numpy.full(shape, tiles["wall"], dtype = numpy.uint8)
+ result[floor] = tiles["floor"]
+ result[rocks] = tiles["rock"]
+ result[chest_mask] = tiles["chest"]
+ for (x, y), tile in anchors.items():
+  result[y, x] = tile
+
+ # Hand the chests out in a shuffled order, so the contents don't just
+ # end up sorted top to bottom.
+ ys, xs = numpy.nonzero(chest_mask)
+ positions = list(zip(xs.tolist(), ys.tolist()))
+ rng.shuffle(positions)
+ return Layout(result, floor, reached, positions, start)
+
+# Generates a valid layout from the given seed, retrying until one
+# passes (or giving up after "attempts" tries). The same arguments
+# always give the same layout.
+def generate(shape, seed, chests, anchors, tiles, attempts = 10000):
+ if seed is None:
+  raise ValueError("Layouts need a seed, or they'd be different every time.")
+ rng = random.Random(seed)
+ for attempt in range(attempts):
+  layout = candidate(shape, rng, chests, anchors, tiles)
+  if layout is not None:
+   return layout
+ raise ValueError("Couldn't generate a layout with {} chests in {} attempts.".format(chests, attempts))
+
+# Scores a layout by how interesting it is to walk around: chests that
+# are a long way from the start and from each other are good, and dead
+# ends are bad.
+def score(layout, weights = WEIGHTS):
+ walkable = layout.reached
+ steps = distances(walkable, layout.start)
+
+ # A chest is opened from the tile next to it, so its distance is that
+ # of its closest reachable neighbour, plus one.
+ padded = numpy.pad(numpy.where(steps >= 0, steps, numpy.iinfo(numpy.int32).max), 1, constant_values = numpy.iinfo(numpy.int32).max)
+ path = 0.0
+ for x, y in layout.chests:
+  path += min(padded[y, x + 1], padded[y + 2, x + 1], padded[y + 1, x], padded[y + 1, x + 2]) + 1
+ if len(layout.chests) > 0:
+  path /= len(layout.chests)
+
+ spread = 0.0
+ if len(layout.chests) > 1:
+  points = numpy.array(layout.chests)
+  gaps = numpy.abs(points[:, None, :] - points[None, :, :]).sum(axis = 2)
+  spread = gaps.sum() / (len(points) * (len(points) - 1))
+
+ neighbours = numpy.zeros(walkable.shape, dtype = numpy.int32)
+ neighbours[1:, :] += walkable[:-1, :]
+ neighbours[:-1, :] += walkable[1:, :]
+ neighbours[:, 1:] += walkable[:, :-1]
+ neighbours[:, :-1] += walkable[:, 1:]
+ dead_ends = numpy.count_nonzero(walkable & (neighbours == 1))
+
+ return float(weights["path"] * path + weights["spread"] * spread + weights["dead_ends"] * dead_ends)
+
+# Derives the seed for the index-th candidate of a search. It only
+# depends on the search seed and the index, so every candidate is the
+# same no matter which worker ends up making it.
+def candidate_seed(seed, index):
+ digest = hashlib.sha256("{}:{}".format(seed, index).encode()).digest()
+ return int.from_bytes(digest[0:8], "little")
+
+def scored_layout(arguments):
+ shape, seed, chests, anchors, tiles = arguments
+ layout = generate(shape, seed, chests, anchors, tiles)
+ return score(layout), layout
+
+# Generates "count" layouts (each one from its own derived seed) across
+# a pool of worker processes and returns the best scoring one. Ties go
+# to the lowest numbered candidate, so the result only depends on the
+# seed and the count, never on the number of workers. Like generate,
+# it needs a real seed: candidate_seed would happily hash None, giving
+# every rom the same layouts.
+def search(shape, seed, count, chests, anchors, tiles, workers = None):
+ if seed is None:
+  raise ValueError("Layouts need a seed, or they'd be the same for every rom.")
+ jobs = [(shape, candidate_seed(seed, index), chests, anchors, tiles) for index in range(count)]
+ if workers == 1:
+  results = list(map(scored_layout, jobs))
+ else:
+  with ProcessPoolExecutor(workers) as pool:
+   results = list(pool.map(scored_layout, jobs, chunksize = max(1, count // 32)))
+ best = 0
+ for index in range(1, count):
+  if results[index][0] > results[best][0]:
+   best = index
+ return results[best][1]
@@ -0,0 +1,273 @@
+import os
+from array import array
+
+from event import Instruction
+from cache import RESULTS_DIR, evict, rom_hash
+
+# Decodes event scripts straight from the rom, including Free
+# Enterprise's extended E6 instructions, which gamingway doesn't know
+# about. An E6 instruction is followed by an extended opcode, and the
+# number of parameters depends on that opcode rather than on E6 itself.
+#
+# The rom is scanned once to find where every instruction of every
+# event starts, and that scan is cached on disk by rom hash (next to the
+# cached results, so it gets thrown out along with them), so running it
+# again on the same rom skips it entirely. The scripts themselves are
+# only turned into Instruction objects when they're asked for.
+
+extended_instruction_names = {
+ 0x00: "End event",
+ 0x01: "Goto event",
+ 0x02: "If",
+ 0x03: "Age Rydia",
+ 0x04: "Placement set visible",
+ 0x05: "Placement set invisible",
+ 0x06: "Put Enterprise",
+ 0x07: "Party leader Cecil",
+ 0x08: "Activate NPC",
+ 0x09: "Deactivate NPC",
+ 0x0A: "Party leader character",
+ 0x0B: "Rememberize Tellah",
+ 0x0C: "Clear shadow party slot",
+ 0x0D: "Save vehicles from Mist",
+ 0x0E: "Load extra NPC palette",
+ 0x0F: "Reset NPC palette",
+ 0x10: "Debug buff",
+ 0x11: "Placement set visible by party leader",
+ 0x12: "Reload placement sprite",
+ 0x13: "Set placement speed",
+ 0x14: "Give float",
+ 0x15: "Clear party",
+ 0x16: "Debug fill shadow party",
+ 0x17: "Gosub event",
+ 0x18: "Return",
+ 0x19: "Load NPC palette",
+ 0x1A: "Test mode startup",
+ 0x1B: "Save music",
+ 0x1C: "Restore music",
+ 0x1D: "Take all",
+ 0x1E: "Tint off",
+ 0x1F: "Give starter kit",
+ 0x20: "Key item location hint",
+ 0x21: "Give character",
+ 0x22: "Paladinize Cecil",
+ 0x23: "Check character alt version",
+ 0x24: "Boss battle",
+ 0x25: "Check flag",
+ 0x26: "Give item side effects",
+ 0x27: "Init axtor name",
+ 0x28: "Deliver reward from slot",
+ 0x29: "Check flag equals",
+ 0x2A: "Post boss battle",
+ 0x2B: "Increase key item count",
+ 0x2C: "Retrieve character",
+ 0x2D: "Load wacky sprite",
+ 0x2E: "Load axtor fashion code",
+ 0x2F: "Give pink tail item",
+ 0x30: "Init vignette loop",
+ 0x31: "Check vignettes done",
+ 0x32: "Load vignette map",
+ 0x33: "Draw vignette window",
+ 0x34: "Next vignette",
+ 0x35: "Finalize stats",
+ 0x36: "Save endgame time",
+ # 0x37 unused?
+ 0x38: "Set key item used",
+ # 0x39 - 0x3F unused?
+ 0x40: "Load spell name",
+ 0x41: "Load reward name from slot",
+ 0x42: "Load objective name for index",
+ # 0x43 - 0x4F unused?
+ 0x50: "Objectives impl. apply staged",
+ 0x51: "Objectives impl. show staged completion messages",
+ 0x52: "Objectives tick",
+ 0x53: "Objectives tick boss slot",
+ 0x54: "Objectives tick reward slot",
+ 0x55: "Objectives list in dialog"
+}
+
+extended_parameter_count = {
+ # These are all guesses...
+ 0x00: 0,
+ 0x01: 1,
+ 0x02: 3,
+ 0x03: 0,
+ 0x04: 1,
+ 0x05: 1,
+ 0x06: 3,
+ 0x07: 0,
+ 0x08: 1,
+ 0x09: 1,
+ 0x0A: 1,
+ 0x0B: 0,
+ 0x0C: 1,
+ 0x0D: 0,
+ 0x0E: 0,
+ 0x0F: 0,
+ 0x10: 0,
+ 0x11: 1,
+ 0x12: 1,
+ 0x13: 2,
+ 0x14: 0,
+ 0x15: 0,
+ 0x16: 0,
+ 0x17: 1,
+ 0x18: 0,
+ 0x19: 0,
+ 0x1A: 0,
+ 0x1B: 0,
+ 0x1C: 0,
+ 0x1D: 0,
+ 0x1E: 0,
+ 0x1F: 0,
+ 0x20: 1,
+ 0x21: 1,
+ 0x22: 0,
+ 0x23: 1,
+ 0x24: 1,
+ 0x25: 1,
+ 0x26: 1,
+ 0x27: 1,
+ 0x28: 1,
+ 0x29: 2,
+ 0x2A: 0,
+ 0x2B: 0,
+ 0x2C: 1,
+ 0x2D: 1,
+ 0x2E: 2,
+ 0x2F: 0,
+ 0x30: 0,
+ 0x31: 0,
+ 0x32: 0,
+ 0x33: 0,
+ 0x34: 0,
+ 0x35: 0,
+ 0x36: 0,
+ # 0x37 unused?
+ 0x38: 1,
+ # 0x39 - 0x3F unused?
+ 0x40: 1,
+ 0x41: 2,
+ 0x42: 1,
+ # 0x43 - 0x4F unused?
+ 0x50: 0,
+ 0x51: 0,
+ 0x52: 0,
+ 0x53: 1,
+ 0x54: 1,
+ 0x55: 0
+}
+
+# Bump this whenever the decoding changes so old cached scans get
+# ignored.
+DECODER_VERSION = 1
+
+class EventDecoder:
+ def __init__(self, data, boundaries):
+  self.data = data
+  self.boundaries = boundaries
+  self.scripts = {}
+
+ def __len__(self):
+  return len(self.boundaries)
+
+ # Returns the decoded script of the given event, decoding it the first
+ # time it's asked for.
+ def script(self, index):
+  if index not in self.scripts:
+   offsets = self.boundaries[index]
+   script = []
+   for position in range(len(offsets) - 1):
+    start = offsets[position]
+    end = offsets[position + 1]
+    code = self.data[start]
+    script.append(Instruction(code, list(self.data[start + 1:end])))
+   self.scripts[index] = script
+  return self.scripts[index]
+
+ # Replaces gamingway's own parse of the events with ours. This decodes
+ # everything, so it's only worth doing before writing the events back.
+ def install(self, ff4):
+  for index, event in enumerate(ff4.events):
+   event.script = self.script(index)
+
+# Finds where every instruction starts, for every event, in one pass.
+# Each event's list ends with the offset of its FF terminator.
+def scan_events(data, pointers_start, pointer_bonus, count, parameter_count):
+ boundaries = []
+ for index in range(count):
+  pointer = pointers_start + index * 2
+  offset = data[pointer] + data[pointer + 1] * 0x100 + pointer_bonus
+  offsets = array("I")
+  code = data[offset]
+  while code != 0xFF:
+   offsets.append(offset)
+   if code == 0xE6:
+    offset += 2 + extended_parameter_count[data[offset + 1]]
+   else:
+    offset += 1 + parameter_count[code]
+   code = data[offset]
+  offsets.append(offset)
+  boundaries.append(offsets)
+ return boundaries
+
+# A scan is saved as plain 32 bit words: the number of events, the
+# number of offsets each one has, and then all the offsets one event
+# after another. Loading it back is just reading them into an array.
+def save_boundaries(filename, boundaries):
+ words = array("I", [len(boundaries)])
+ words.extend(len(offsets) for offsets in boundaries)
+ for offsets in boundaries:
+  words.extend(offsets)
+ temporary = "{}.{}.tmp".format(filename, os.getpid())
+ with open(temporary, "wb") as file:
+  words.tofile(file)
+ os.replace(temporary, filename)
+
+# Returns the saved scan, or raises ValueError if the file doesn't hold
+# one with "count" events.
+def load_boundaries(filename, count):
+ words = array("I")
+ with open(filename, "rb") as file:
+  words.frombytes(file.read())
+ if len(words) < 1 or words[0] != count or len(words) < 1 + count:
+  raise ValueError("Not a scan of {} events.".format(count))
+ lengths = words[1:1 + count]
+ if 1 + count + sum(lengths) != len(words):
+  raise ValueError("Event scan has the wrong size.")
+ boundaries = []
+ position = 1 + count
+ for length in lengths:
+  boundaries.append(words[position:position + length])
+  position += length
+ return boundaries
+
+# The decoder of the last rom loaded in this process, as (key, decoder).
+# Batch workers and the server go through one rom after another, so
+# holding on to more than that would only pile up old roms in memory.
+current = None
+
+# Returns the event decoder for the given (already read) rom, reusing
+# the last one or the scan cached on disk when the rom has been scanned
+# before.
+def load(ff4):
+ global current
+ if hasattr(ff4, "event_decoder"):
+  return ff4.event_decoder
+ data = bytes(ff4.rom.data)
+ key = "{}-{}".format(rom_hash(data), DECODER_VERSION)
+ if current is None or current[0] != key:
+  cachefile = os.path.join(RESULTS_DIR, "events-{}.scan".format(key))
+  count = len(ff4.events)
+  try:
+   boundaries = load_boundaries(cachefile, count)
+   os.utime(cachefile)
+  except (OSError, ValueError):
+   rom = ff4.rom
+   boundaries = scan_events(data, rom.EVENT_POINTERS_START, rom.EVENT_POINTER_BONUS, count, ff4.config.parameter_count)
+   os.makedirs(RESULTS_DIR, exist_ok = True)
+   save_boundaries(cachefile, boundaries)
+   evict()
+  current = (key, EventDecoder(data, boundaries))
+ ff4.event_decoder = current[1]
+ return ff4.event_decoder
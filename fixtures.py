@@ -0,0 +1,129 @@
+import os
+import random
+import tempfile
+
+import patch
+import voyager
+from eventdecoder import extended_parameter_count
+
+# Builds synthetic Free Enterprise style roms for benchmarking, since
+# real roms can't be shared. The image has a copier header and is the
+# size of an expanded FE rom, and fills in the parts Voyager itself
+# looks at:
+#  * the item description block at 0x120200, with properly framed
+#    lines of text (some mentioning spell names, so the renames have
+#    something to do)
+#  * the trigger table, as a run of treasure chests holding J-items,
+#    with the per-map trigger pointers handing them out to the first
+#    MAPS_WITH_TRIGGERS maps (so the maps really own the chests)
+#  * the event pointers, each pointing at a short script mixing normal
+#    and E6 extended instructions
+# Everything else is left blank for gamingway to parse as empty tables.
+# The addresses and text encoding come from gamingway itself, so the
+# image always matches what the installed version expects.
+
+ROM_SIZE = 0x200000
+HEADER_SIZE = 0x200
+ITEM_COUNT = 0x100
+TRIGGER_COUNT = 0x200
+MAP_COUNT = 0x200
+MAPS_WITH_TRIGGERS = 0x40
+EVENT_COUNT = 0x200
+
+WORDS = ["Fire1", "Ice2", "Lit-3", "Cure1", "Life1", "Holy", "Stop", "Casts", "Strong", "against", "undead.", "Two-handed.", "STR+5.", "WIL+3."]
+
+# Items worth converting, so convert_jitems has chests to rewrite.
+JITEMS = range(0xB0, 0xC8)
+
+# Event instructions with no parameters that are safe to sprinkle into
+# the scripts.
+SIMPLE_INSTRUCTIONS = [0xC0, 0xC1, 0xC2, 0xC3]
+
+# Writes a blank image and lets gamingway open it, just to get at the
+# rom addresses and text table of the installed gamingway version.
+def gamingway_rom(size = ROM_SIZE):
+ handle, filename = tempfile.mkstemp(suffix = ".smc")
+ with os.fdopen(handle, "wb") as file:
+  file.write(bytes(HEADER_SIZE + size))
+ try:
+  return patch.FF4Rom(filename)
+ finally:
+  os.remove(filename)
+
+def description_line(ff4, rng):
+ words = []
+ while len(" ".join(words)) < 20:
+  words.append(rng.choice(WORDS))
+ text = ff4.text.ff4text(" ".join(words))[0:voyager.LINE_LENGTH]
+ text = text.ljust(voyager.LINE_LENGTH, ff4.text.ff4text(" "))
+ return bytes([0x00, 0xFA] + ff4.text.to_bytes(text) + [0xFB, 0x00, 0x00])
+
+def fill_descriptions(ff4, data, rng):
+ for index in range(ITEM_COUNT):
+  for y in range(4):
+   address = voyager.DESCRIPTIONS_START + index * voyager.DESCRIPTION_SIZE + y * voyager.LINE_SIZE
+   data[address:address + voyager.LINE_SIZE] = description_line(ff4, rng)
+
+# Treasure triggers are x, y, FE (treasure), flags, contents. Gamingway
+# works out which triggers belong to which map from the trigger
+# pointers (one per map, pointing at its first trigger), so those get
+# filled in too: the triggers are split evenly over the first
+# MAPS_WITH_TRIGGERS maps, and the rest of the maps point past the end
+# and get none.
+def fill_triggers(ff4, data, rng):
+ address = ff4.rom.TRIGGER_DATA_START
+ for index in range(TRIGGER_COUNT):
+  data[address:address + voyager.TRIGGER_SIZE] = bytes([rng.randrange(32), rng.randrange(32), 0xFE, 0x00, rng.choice(JITEMS)])
+  address += voyager.TRIGGER_SIZE
+
+ pointers = ff4.rom.TRIGGER_POINTERS_START
+ bonus = ff4.rom.TRIGGER_POINTER_BONUS
+ per_map = TRIGGER_COUNT // MAPS_WITH_TRIGGERS
+ for index in range(MAP_COUNT):
+  first = min(index, MAPS_WITH_TRIGGERS) * per_map
+  offset = ff4.rom.TRIGGER_DATA_START + first * voyager.TRIGGER_SIZE - bonus
+  data[pointers + index * 2] = offset & 0xFF
+  data[pointers + index * 2 + 1] = offset >> 8
+
+def fill_events(ff4, data, rng):
+ extended = sorted(extended_parameter_count)
+ pointers = ff4.rom.EVENT_POINTERS_START
+ bonus = ff4.rom.EVENT_POINTER_BONUS
+ address = bonus
+ for index in range(EVENT_COUNT):
+  data[pointers + index * 2] = (address - bonus) & 0xFF
+  data[pointers + index * 2 + 1] = (address - bonus) >> 8
+  script = bytearray()
+  for count in range(rng.randrange(1, 12)):
+   if rng.random() < 0.3:
+    code = rng.choice(extended)
+    script += bytes([0xE6, code] + [rng.randrange(256) for parameter in range(extended_parameter_count[code])])
+   else:
+    script.append(rng.choice(SIMPLE_INSTRUCTIONS))
+  script.append(0xFF)
+  data[address:address + len(script)] = script
+  address += len(script)
+
+# Returns the bytes of a synthetic rom. The same seed always gives the
+# same rom.
+def build_rom(seed = 0, size = ROM_SIZE):
+ rng = random.Random(seed)
+ ff4 = gamingway_rom(size)
+ data = bytearray(HEADER_SIZE + size)
+ fill_descriptions(ff4, data, rng)
+ fill_triggers(ff4, data, rng)
+ fill_events(ff4, data, rng)
+ return bytes(data)
+
+def write_rom(filename, seed = 0, size = ROM_SIZE):
+ with open(filename, "wb") as file:
+  file.write(build_rom(seed, size))
+ return filename
+
+# Makes sure gamingway really sees the chests on the maps, by checking
+# that convert_jitems finds some to convert. Otherwise the trigger
+# benchmarks would just be timing empty loops.
+def check_rom(filename):
+ ff4 = patch.load_rom(filename)
+ if len(voyager.convert_jitems(ff4)) == 0:
+  raise ValueError("No map in {} has any J-item chests to convert.".format(filename))
@@ -0,0 +1,93 @@
+import numpy
+
+# A 2-D view of a tilemap (or the overworld) as a uint8 NumPy array, so
+# that map edits can work on whole regions at once instead of walking
+# tiles[y][x] cell by cell.
+#
+# Gamingway keeps the tiles as a list of rows, so the grid works on a
+# copy and write_back() puts back only the rows that actually changed.
+# Used as a context manager it writes back automatically:
+#
+#   with TileGrid(tilemap.tiles) as grid:
+#    grid.fill(1, 1, 30, 30, floortile)
+#
+# Positions are always given as (x, y) like in the rest of Voyager, even
+# though the array itself is indexed [y, x].
+
+class TileGrid:
+ def __init__(self, tiles):
+  self.tiles = tiles
+  self.array = numpy.array(tiles, dtype = numpy.uint8)
+  self.original = self.array.copy()
+
+ @property
+ def width(self):
+  return self.array.shape[1]
+
+ @property
+ def height(self):
+  return self.array.shape[0]
+
+ def __getitem__(self, position):
+  x, y = position
+  return int(self.array[y, x])
+
+ def __setitem__(self, position, tile):
+  x, y = position
+  self.array[y, x] = tile
+
+ # Returns a boolean array that's True wherever the tile is one of the
+ # given ones.
+ def mask(self, tiles):
+  return numpy.isin(self.array, tiles)
+
+ # Fills a (w by h) rectangle starting at (x, y) with the given tile.
+ def fill(self, x, y, w, h, tile):
+  self.array[y:y + h, x:x + w] = tile
+
+ # Replaces every "old" tile (or any of a list of them) with "new",
+ # optionally only where "where" (a boolean array) is True. Returns how
+ # many tiles were replaced.
+ def replace(self, old, new, where = None):
+  mask = self.mask(old)
+  if where is not None:
+   mask &= where
+  self.array[mask] = new
+  return int(numpy.count_nonzero(mask))
+
+ # Returns the (x, y) positions of every one of the given tile(s), in
+ # reading order.
+ def find(self, tiles):
+  ys, xs = numpy.nonzero(self.mask(tiles))
+  return list(zip(xs.tolist(), ys.tolist()))
+
+ # Returns the smallest (x, y, w, h) box holding every one of the given
+ # tile(s), or None if there aren't any.
+ def bbox(self, tiles):
+  ys, xs = numpy.nonzero(self.mask(tiles))
+  if len(xs) == 0:
+   return None
+  x, y = int(xs.min()), int(ys.min())
+  return (x, y, int(xs.max()) - x + 1, int(ys.max()) - y + 1)
+
+ def changed_rows(self):
+  return numpy.flatnonzero((self.array != self.original).any(axis = 1)).tolist()
+
+ # Copies the changed rows back into the tile lists and returns their
+ # indexes.
+ def write_back(self):
+  rows = self.changed_rows()
+  for y in rows:
+   self.tiles[y][:] = self.array[y].tolist()
+   self.original[y] = self.array[y]
+  return rows
+
+ def __enter__(self):
+  return self
+
+ def __exit__(self, kind, value, traceback):
+  if kind is None:
+   self.write_back()
+
+ def __str__(self):
+  return "\n".join(" ".join("{:02X}".format(tile) for tile in row) for row in self.array.tolist())
@@ -0,0 +1,120 @@
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import delta
+
+# Optional timing and memory instrumentation for the patching pipeline.
+# Every step (and the read, write and save phases around them) can be
+# wrapped in Profiler.measure, which records:
+#  * wall - wall clock seconds
+#  * cpu - CPU seconds used by this process
+#  * memory - how far memory use peaked above where it started, in bytes
+#  * written - how many bytes of the rom changed
+#
+# Nothing here runs unless a Profiler is passed in, since tracking
+# memory and comparing the rom before and after each step both slow
+# things down considerably.
+
+class Profiler:
+ def __init__(self, label = ""):
+  self.label = label
+  self.records = []
+  self.origin = time.perf_counter()
+
+ # Measures the block it wraps. If "data" (the rom's bytes) is given,
+ # it also counts how many of them the block changed.
+ @contextmanager
+ def measure(self, name, data = None, kind = "step"):
+  before = bytes(data) if data is not None else None
+  started_tracing = not tracemalloc.is_tracing()
+  if started_tracing:
+   tracemalloc.start()
+  tracemalloc.reset_peak()
+  memory = tracemalloc.get_traced_memory()[0]
+  start = time.perf_counter()
+  cpu = time.process_time()
+  try:
+   yield
+  finally:
+   wall = time.perf_counter() - start
+   cpu = time.process_time() - cpu
+   peak = tracemalloc.get_traced_memory()[1] - memory
+   if started_tracing:
+    tracemalloc.stop()
+   written = 0
+   if before is not None:
+    written = sum(len(chunk) for offset, chunk in delta.diff(before, bytes(data)))
+   self.records.append({
+    "name": name,
+    "kind": kind,
+    "start": start - self.origin,
+    "wall": wall,
+    "cpu": cpu,
+    "memory": peak,
+    "written": written
+   })
+
+ def report(self):
+  return {"label": self.label, "records": self.records}
+
+ # The same records in Chrome's trace event format, which can be opened
+ # in chrome://tracing or Perfetto.
+ def chrome_trace(self):
+  events = []
+  for record in self.records:
+   events.append({
+    "name": record["name"],
+    "cat": record["kind"],
+    "ph": "X",
+    "ts": record["start"] * 1000000,
+    "dur": record["wall"] * 1000000,
+    "pid": os.getpid(),
+    "tid": 0,
+    "args": {key: record[key] for key in ("cpu", "memory", "written")}
+   })
+  return {"traceEvents": events, "otherData": {"label": self.label}}
+
+ # Saves the records as JSON, or as a Chrome trace if the file name
+ # ends in ".trace.json".
+ def save(self, filename):
+  if filename.endswith(".trace.json"):
+   output = self.chrome_trace()
+  else:
+   output = self.report()
+  with open(filename, "w") as file:
+   json.dump(output, file, indent = 1)
+
+# Shortcut for code that may or may not have been given a profiler.
+def measure(profiler, name, data = None, kind = "step"):
+ if profiler is None:
+  return nullcontext()
+ return profiler.measure(name, data, kind)
+
+# Combines the reports of many roms (say, a whole batch) into totals
+# per step.
+def aggregate(reports):
+ totals = {}
+ for report in reports:
+  for record in report["records"]:
+   total = totals.setdefault(record["name"], {"kind": record["kind"], "runs": 0, "wall": 0.0, "cpu": 0.0, "max_wall": 0.0, "max_memory": 0, "written": 0})
+   total["runs"] += 1
+   total["wall"] += record["wall"]
+   total["cpu"] += record["cpu"]
+   total["max_wall"] = max(total["max_wall"], record["wall"])
+   total["max_memory"] = max(total["max_memory"], record["memory"])
+   total["written"] += record["written"]
+ for total in totals.values():
+  total["mean_wall"] = total["wall"] / total["runs"]
+ return {"roms": len(reports), "steps": totals}
+
+# Aggregates every per-rom JSON report saved in a folder.
+def aggregate_folder(folder):
+ reports = []
+ for name in sorted(os.listdir(folder)):
+  if name.endswith(".json") and not name.endswith((".trace.json", ".journal.json")) and name != "summary.json":
+   with open(os.path.join(folder, name)) as file:
+    reports.append(json.load(file))
+ return aggregate(reports)
@@ -0,0 +1,282 @@
+import os
+import random
+import zlib
+
+import delta
+
+# Reading IPS patches, and creating IPS and BPS patches so that a
+# patched seed can be stored or sent as just the changes Voyager made
+# rather than a whole rom.
+#
+# Patches that get applied are parsed once per process and kept in
+# memory, so applying one again (say, to every rom in a batch) is just
+# a handful of slice assignments with no file reading or parsing.
+#
+# IPS is the simpler (and more widely supported) format, but it can't
+# address anything past 16 MB and every record costs 5 bytes of
+# overhead, so BPS is the better choice for big or heavily changed
+# roms. Which one gets written is decided by the output file extension.
+#
+# Running this file (python ips.py) makes patches for a few awkward
+# cases (a record at the "EOF" offset, runs too long for one IPS record,
+# growing and shrinking the rom) and checks that applying them gives
+# back the new rom exactly.
+
+PATCH_EXTENSIONS = (".ips", ".bps")
+
+IPS_HEADER = b"PATCH"
+IPS_FOOTER = b"EOF"
+IPS_MAX_OFFSET = 0xFFFFFF
+IPS_MAX_RECORD = 0xFFFF
+
+# Any record starting at this offset would read as the "EOF" footer.
+IPS_EOF_OFFSET = 0x454F46
+
+BPS_HEADER = b"BPS1"
+BPS_SOURCE_READ = 0
+BPS_TARGET_READ = 1
+BPS_SOURCE_COPY = 2
+BPS_TARGET_COPY = 3
+
+def is_patch_file(filename):
+ return filename.lower().endswith(PATCH_EXTENSIONS)
+
+def make_ips(old, new):
+ patch = bytearray(IPS_HEADER)
+ for offset, chunk in delta.diff(old, new):
+  position = 0
+  while position < len(chunk):
+   start = offset + position
+   piece = chunk[position:position + IPS_MAX_RECORD]
+
+   # Back up one byte so the record doesn't start at "EOF". That byte
+   # is unchanged (or it would have been part of the run), so it's
+   # just written with its new value, which is the same as the old.
+   if start == IPS_EOF_OFFSET:
+    start -= 1
+    piece = new[start:start + 1] + piece[:IPS_MAX_RECORD - 1]
+   if start + len(piece) - 1 > IPS_MAX_OFFSET:
+    raise ValueError("IPS patches can't reach past 16 MB; use BPS instead.")
+   patch += start.to_bytes(3, "big") + len(piece).to_bytes(2, "big") + piece
+   position = start + len(piece) - offset
+ patch += IPS_FOOTER
+
+ # The (widely supported) truncation extension, for when the new rom is
+ # smaller than the old one.
+ if len(new) < len(old):
+  patch += len(new).to_bytes(3, "big")
+ return bytes(patch)
+
+def bps_number(value):
+ encoded = bytearray()
+ while True:
+  low = value & 0x7F
+  value >>= 7
+  if value == 0:
+   encoded.append(0x80 | low)
+   return encoded
+  encoded.append(low)
+  value -= 1
+
+def make_bps(old, new):
+ patch = bytearray(BPS_HEADER)
+ patch += bps_number(len(old))
+ patch += bps_number(len(new))
+ patch += bps_number(0)
+
+ # Unchanged stretches are copied from the source, and changed ones are
+ # stored in full.
+ position = 0
+ for offset, chunk in delta.diff(old, new):
+  if offset > position:
+   patch += bps_number(((offset - position - 1) << 2) | BPS_SOURCE_READ)
+  patch += bps_number(((len(chunk) - 1) << 2) | BPS_TARGET_READ)
+  patch += chunk
+  position = offset + len(chunk)
+ if position < len(new):
+  patch += bps_number(((len(new) - position - 1) << 2) | BPS_SOURCE_READ)
+
+ patch += zlib.crc32(old).to_bytes(4, "little")
+ patch += zlib.crc32(new).to_bytes(4, "little")
+ patch += zlib.crc32(patch).to_bytes(4, "little")
+ return bytes(patch)
+
+def read_bps_number(patch, position):
+ value = 0
+ shift = 1
+ while True:
+  byte = patch[position]
+  position += 1
+  value += (byte & 0x7F) * shift
+  if byte & 0x80:
+   return value, position
+  shift <<= 7
+  value += shift
+
+# Applies a BPS patch to "old" and returns the new rom, checking the
+# checksums along the way.
+def apply_bps(old, patch):
+ if patch[0:len(BPS_HEADER)] != BPS_HEADER:
+  raise ValueError("Not a BPS patch.")
+ if zlib.crc32(patch[:-4]) != int.from_bytes(patch[-4:], "little"):
+  raise ValueError("BPS patch is damaged.")
+ if zlib.crc32(old) != int.from_bytes(patch[-12:-8], "little"):
+  raise ValueError("BPS patch is for a different rom.")
+ position = len(BPS_HEADER)
+ source_size, position = read_bps_number(patch, position)
+ target_size, position = read_bps_number(patch, position)
+ metadata, position = read_bps_number(patch, position)
+ position += metadata
+ new = bytearray()
+ source_offset = 0
+ target_offset = 0
+ while position < len(patch) - 12:
+  action, position = read_bps_number(patch, position)
+  kind = action & 3
+  length = (action >> 2) + 1
+  if kind == BPS_SOURCE_READ:
+   new += old[len(new):len(new) + length]
+  elif kind == BPS_TARGET_READ:
+   new += patch[position:position + length]
+   position += length
+  else:
+   relative, position = read_bps_number(patch, position)
+   relative = -(relative >> 1) if relative & 1 else relative >> 1
+   if kind == BPS_SOURCE_COPY:
+    source_offset += relative
+    new += old[source_offset:source_offset + length]
+    source_offset += length
+   else:
+    target_offset += relative
+    for index in range(length):
+     new.append(new[target_offset + index])
+    target_offset += length
+ if len(new) != target_size or zlib.crc32(new) != int.from_bytes(patch[-8:-4], "little"):
+  raise ValueError("BPS patch didn't produce the right rom.")
+ return bytes(new)
+
+# Makes whichever kind of patch the file name asks for.
+def make_patch(old, new, filename):
+ if filename.lower().endswith(".bps"):
+  return make_bps(old, new)
+ return make_ips(old, new)
+
+# The size of the copier header some roms have in front of them.
+HEADER_SIZE = 0x200
+
+# The IPS patches that come with Voyager, and whether each one was made
+# for a headered or unheadered rom.
+BUNDLED = {
+ "Black Chocobo Fix.ips": "headered",
+ "Custom Salve.ips": "unheadered",
+ "Dark Wave Fix.ips": "unheadered"
+}
+
+# A parsed IPS patch. The records are kept as (offset, bytes) pairs
+# with RLE records already expanded, and the offsets are always stored
+# relative to an unheadered rom; the rom's own header (if it has one)
+# is added back when the patch is applied.
+class IPSPatch:
+ def __init__(self, records, truncate = None):
+  self.records = records
+  self.truncate = truncate
+
+ def apply(self, data):
+  shift = header_size(data)
+  for offset, chunk in self.records:
+   start = offset + shift
+   if start + len(chunk) > len(data):
+    data.extend(bytes(start + len(chunk) - len(data)))
+   data[start:start + len(chunk)] = chunk
+  if self.truncate is not None:
+   del data[self.truncate + shift:]
+
+def header_size(data):
+ return HEADER_SIZE if len(data) % 0x400 == HEADER_SIZE else 0
+
+# Parses (and checks) the contents of an IPS file. "header" says whether
+# the patch was made for a "headered" or "unheadered" rom.
+def parse_ips(raw, header = "unheadered"):
+ if raw[0:len(IPS_HEADER)] != IPS_HEADER:
+  raise ValueError("Not an IPS patch.")
+ shift = HEADER_SIZE if header == "headered" else 0
+ records = []
+ position = len(IPS_HEADER)
+ while raw[position:position + 3] != IPS_FOOTER:
+  if position + 5 > len(raw):
+   raise ValueError("IPS patch ends in the middle of a record.")
+  offset = int.from_bytes(raw[position:position + 3], "big") - shift
+  size = int.from_bytes(raw[position + 3:position + 5], "big")
+  position += 5
+  if size == 0:
+   if position + 3 > len(raw):
+    raise ValueError("IPS patch ends in the middle of an RLE record.")
+   size = int.from_bytes(raw[position:position + 2], "big")
+   chunk = raw[position + 2:position + 3] * size
+   position += 3
+  else:
+   chunk = raw[position:position + size]
+   if len(chunk) < size:
+    raise ValueError("IPS patch ends in the middle of a record.")
+   position += size
+  if offset < 0:
+   raise ValueError("IPS record at {:06X} falls inside the header.".format(offset + shift))
+  records.append((offset, bytes(chunk)))
+ position += len(IPS_FOOTER)
+ truncate = None
+ if len(raw) >= position + 3:
+  truncate = int.from_bytes(raw[position:position + 3], "big") - shift
+ return IPSPatch(records, truncate)
+
+# Parsed patches, by file and header type.
+patches = {}
+
+def load_patch(filename, header = "unheadered"):
+ key = (os.path.abspath(filename), header)
+ if key not in patches:
+  with open(filename, "rb") as file:
+   patches[key] = parse_ips(file.read(), header)
+ return patches[key]
+
+# The folder the bundled patches ship in, next to this file. It ends in
+# a separator since the steps add the file names straight onto it.
+BUNDLED_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ips", "")
+
+# Loads every bundled patch from the given folder up front.
+def preload(patchpath):
+ for name, header in BUNDLED.items():
+  load_patch(os.path.join(patchpath, name), header)
+
+# Makes IPS and BPS patches for the cases most likely to go wrong and
+# checks that each one turns the old rom back into the new one. Returns
+# the number of cases checked, or raises AssertionError.
+def check_round_trips():
+ size = 0x460000
+ old = random.Random(0).randbytes(size)
+
+ def changed(*runs):
+  new = bytearray(old)
+  for start, length in runs:
+   new[start:start + length] = bytes(255 - byte for byte in old[start:start + length])
+  return bytes(new)
+
+ cases = [
+  ("unchanged", old),
+  ("scattered bytes", changed((0, 1), (0x1234, 3), (size - 1, 1))),
+  ("record at the EOF offset", changed((IPS_EOF_OFFSET, 4))),
+  ("run longer than one IPS record", changed((0x1000, 0x20000))),
+  ("split record landing on the EOF offset", changed((IPS_EOF_OFFSET - IPS_MAX_RECORD, IPS_MAX_RECORD + 0x10))),
+  ("grown rom", old + bytes(0x400)),
+  ("truncated rom", changed((0x100, 2))[:size - 0x400])
+ ]
+ for name, new in cases:
+  result = bytearray(old)
+  parse_ips(make_ips(old, new)).apply(result)
+  if bytes(result) != new:
+   raise AssertionError("IPS round trip failed: {}".format(name))
+  if apply_bps(old, make_bps(old, new)) != new:
+   raise AssertionError("BPS round trip failed: {}".format(name))
+ return len(cases)
+
+if __name__ == "__main__":
+ print("{} IPS and BPS round trips OK".format(check_round_trips()))
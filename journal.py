@@ -0,0 +1,192 @@
+import json
+from contextlib import contextmanager, nullcontext
+
+import delta
+
+# An optional record of everything the pipeline changes, step by step:
+#  * writes - (step, address, old bytes, new bytes) for every run of rom
+#    bytes that changed, whether a step poked them in directly, applied
+#    an IPS patch or (in the "write" phase) gamingway wrote a section
+#  * fields - (step, path, old, new) for every field of the parsed rom
+#    that changed, with the path spelled out as attribute names and list
+#    indexes, like ("maps", 12, "triggers", 3, "x")
+#
+# Only the changes are kept, so a journal is small enough to hold on to
+# for every rom in a batch. From it, any subset of the writes can be
+# replayed onto (or reverted from) a rom, or exported, without running
+# the steps again. Note that the sections gamingway writes back only
+# show up as raw writes in the "write" phase, since that's when they get
+# encoded; which step changed what in them is in the field changes.
+#
+# Like the profiler, nothing is recorded unless a Journal is passed in.
+
+# Attributes of the rom that aren't part of the parsed data.
+SKIP = ["rom", "text", "config", "unparsed", "dirty_sections", "trigger_table", "description_block", "event_decoder"]
+
+# How far down the object graph fields are followed. Four levels is
+# enough to get from ff4.maps down to each trigger's fields.
+DEPTH = 4
+
+PRIMITIVES = (int, float, str, bool, type(None))
+
+class Journal:
+ def __init__(self, label = ""):
+  self.label = label
+  self.writes = []
+  self.fields = []
+
+ # Records whatever the wrapped block changes in the rom, under the
+ # given step name.
+ @contextmanager
+ def record(self, step, ff4):
+  before = bytes(ff4.rom.data)
+  fields = snapshot(ff4)
+  try:
+   yield
+  finally:
+   for address, new in delta.diff(before, bytes(ff4.rom.data)):
+    self.writes.append((step, address, before[address:address + len(new)], new))
+   after = snapshot(ff4)
+   for path, value in after.items():
+    old = fields.get(path)
+    if old != value:
+     self.fields.append((step, path, old, value))
+
+ def steps(self):
+  names = []
+  for step, *change in self.writes + self.fields:
+   if step not in names:
+    names.append(step)
+  return names
+
+ def selected(self, entries, steps):
+  if steps is None:
+   return list(entries)
+  return [entry for entry in entries if entry[0] in steps]
+
+ # Applies the recorded writes (of the given steps, or all of them) to
+ # a rom's bytes, in the order they were made.
+ def replay(self, data, steps = None):
+  for step, address, old, new in self.selected(self.writes, steps):
+   if address + len(new) > len(data):
+    data.extend(bytes(address + len(new) - len(data)))
+   data[address:address + len(new)] = new
+  return data
+
+ # Undoes the recorded writes (of the given steps, or all of them), last
+ # one first.
+ def revert(self, data, steps = None):
+  for step, address, old, new in reversed(self.selected(self.writes, steps)):
+   data[address:address + len(old)] = old
+   if len(old) < len(new) and address + len(new) == len(data):
+    del data[address + len(old):]
+  return data
+
+ # Sets the recorded field changes (of the given steps) on a parsed rom,
+ # or sets them back to their old values if "revert" is True. This
+ # doesn't mark anything dirty; that's up to the caller.
+ def apply_fields(self, ff4, steps = None, revert = False):
+  entries = self.selected(self.fields, steps)
+  if revert:
+   entries.reverse()
+  for step, path, old, new in entries:
+   set_field(ff4, path, old if revert else new)
+
+ def report(self):
+  return {
+   "label": self.label,
+   "writes": [[step, address, old.hex(), new.hex()] for step, address, old, new in self.writes],
+   "fields": [[step, list(path), old, new] for step, path, old, new in self.fields]
+  }
+
+ # Saves the journal (or just the given steps) as JSON.
+ def save(self, filename, steps = None):
+  report = self.report()
+  if steps is not None:
+   report["writes"] = [entry for entry in report["writes"] if entry[0] in steps]
+   report["fields"] = [entry for entry in report["fields"] if entry[0] in steps]
+  with open(filename, "w") as file:
+   json.dump(report, file, indent = 1, default = repr)
+
+def load(filename):
+ with open(filename) as file:
+  report = json.load(file)
+ result = Journal(report["label"])
+ for step, address, old, new in report["writes"]:
+  result.writes.append((step, address, bytes.fromhex(old), bytes.fromhex(new)))
+ for step, path, old, new in report["fields"]:
+  result.fields.append((step, tuple(path), thaw(old), thaw(new)))
+ return result
+
+# Lists come back from JSON as lists, but are recorded as tuples.
+def thaw(value):
+ if isinstance(value, list):
+  return tuple(value)
+ return value
+
+# Shortcut for code that may or may not have been given a journal.
+def record(journal, step, ff4):
+ if journal is None:
+  return nullcontext()
+ return journal.record(step, ff4)
+
+# Collects every field of the parsed rom as {path: value}, following
+# both its lists (ff4.maps, ff4.items, ...) and its other objects (such
+# as ff4.overworld). Objects that are just shortcuts to something in one
+# of the lists (like ff4.PALE_DIM) are left out, since their fields are
+# already recorded through the list.
+def snapshot(ff4):
+ listed = set()
+ for value in vars(ff4).values():
+  if isinstance(value, list):
+   listed.update(id(element) for element in value)
+ fields = {}
+ for name, value in vars(ff4).items():
+  if name in SKIP or name.startswith("_"):
+   continue
+  if isinstance(value, list) or (hasattr(value, "__dict__") and id(value) not in listed):
+   collect(value, (name,), fields, DEPTH)
+ return fields
+
+def collect(value, path, fields, depth):
+ if isinstance(value, PRIMITIVES):
+  fields[path] = value
+ elif isinstance(value, (list, tuple)) and all(isinstance(element, PRIMITIVES) for element in value):
+  fields[path] = tuple(value)
+ elif depth <= 0:
+  return
+ elif isinstance(value, list):
+  for index, element in enumerate(value):
+   collect(element, path + (index,), fields, depth - 1)
+ elif hasattr(value, "__iter__") and hasattr(value, "__len__") and hasattr(value, "__dict__"):
+
+  # Objects that act like sequences (such as item descriptions) are
+  # recorded as their contents.
+  contents = tuple(value)
+  if all(isinstance(element, PRIMITIVES) for element in contents):
+   fields[path] = contents
+ elif hasattr(value, "__dict__"):
+  for name, field in vars(value).items():
+   if not name.startswith("_"):
+    collect(field, path + (name,), fields, depth - 1)
+
+def get_field(parent, key):
+ if isinstance(key, int):
+  return parent[key]
+ return getattr(parent, key)
+
+def set_field(ff4, path, value):
+ parent = ff4
+ for key in path[:-1]:
+  parent = get_field(parent, key)
+ key = path[-1]
+ current = get_field(parent, key)
+ if isinstance(value, tuple) and isinstance(current, list):
+  current[:] = value
+ elif isinstance(value, tuple) and hasattr(current, "__setitem__"):
+  for index, element in enumerate(value):
+   current[index] = element
+ elif isinstance(key, int):
+  parent[key] = value
+ else:
+  setattr(parent, key, value)
@@ -1,67 +1,165 @@
+import os
 import sys
+import tempfile
 sys.path.append("E:/Projects/Hacking/Gamingway/Source")
 #sys.path.append("/home/pinkpuff/Projects/Gamingway/Source/")
 from gamingway import FF4Rom
-import voyager
+import cache
+import instrument
+import ips
+import pipeline
+import romimage
 
-#patchpath = "/home/pinkpuff/Projects/Voyager/Resources/"
-patchpath = "E:/Projects/Hacking/Voyager/Resources/"
+# The IPS patches ship in the ips folder next to this file.
+patchpath = ips.BUNDLED_FOLDER
 
-args = sys.argv
-if len(args) < 2:
- inputfile = "../Resources/fe.smc"
-else:
- inputfile = args[1]
-if len(args) < 3:
- outputfile = "../game.smc"
-else:
- print(len(args))
- outputfile = args[2]
+# Loads and parses a rom, with the extra text symbols the item
+# descriptions use. If "sections" is given, only those get parsed right
+# away and the rest are left until something actually uses them.
+# If "image" (a RomImage of the same file) is given, it takes the place
+# of gamingway's own copy of the rom's bytes, so everything the steps
+# read and write goes through the memory map.
+def load_rom(inputfile, sections = None, image = None):
+ if sections is None:
+  ff4 = FF4Rom(inputfile)
+ else:
+  ff4 = LazyFF4Rom(inputfile)
+ if image is not None:
+  ff4.rom.data = image
+ ff4.text.assign_symbol(0xCB, "+")
+ ff4.text.assign_symbol(0xCC, "(")
+ ff4.text.assign_symbol(0xCD, ")")
+ if sections is None:
+  ff4.read()
+ else:
+  for section in sections:
+   ff4.parse(section)
+ return ff4
 
-ff4 = FF4Rom(inputfile)
-ff4.text.assign_symbol(0xCB, "+")
-ff4.text.assign_symbol(0xCC, "(")
-ff4.text.assign_symbol(0xCD, ")")
-ff4.read()
+# An FF4Rom that parses its sections one at a time, on demand. When
+# something asks for an attribute that isn't there yet (say ff4.maps or
+# ff4.PALE_DIM), only the section that provides it gets parsed.
+#
+# Which section that is comes from pipeline.section_for, or else from
+# what earlier parses added: a section adds the same attributes whatever
+# the rom, so the first time each one is parsed in a process, the names
+# it added are noted down for every rom after it. A name no known
+# section provides only makes the sections that haven't been seen yet
+# get parsed, and once every section has been seen it raises
+# AttributeError straight away.
+class LazyFF4Rom(FF4Rom):
+ providers = {}
+ seen = set()
 
-voyager.read_item_descriptions(ff4)
+ def __init__(self, filename):
+  FF4Rom.__init__(self, filename)
+  self.unparsed = list(pipeline.PARSE_SECTIONS)
 
-voyager.fix_sort_position(ff4)
-voyager.rename_spells(ff4)
-voyager.customize_spell_effects(ff4)
-voyager.customize_spellbooks(ff4)
-voyager.rename_equipment(ff4)
-voyager.customize_equips(ff4)
-voyager.customize_equipment(ff4)
-voyager.customize_commands(ff4, patchpath)
-voyager.consistent_starting_levels(ff4)
-voyager.customize_levelups(ff4)
-voyager.customize_monsters(ff4)
-voyager.customize_maps(ff4, patchpath)
-changed_treasures = voyager.convert_jitems(ff4)
-#voyager.procgen(ff4)
+ def parse(self, section):
+  if section in self.unparsed:
+   self.unparsed.remove(section)
+   before = set(self.__dict__)
+   self.read(section)
+   for name in set(self.__dict__) - before:
+    LazyFF4Rom.providers.setdefault(name, section)
+   LazyFF4Rom.seen.add(section)
 
-#for job in ff4.jobs:
-# print(job.display(ff4))
+ def __getattr__(self, name):
+  unparsed = self.__dict__.get("unparsed")
+  if name.startswith("_") or name in pipeline.VOYAGER_STATE or not unparsed:
+   raise AttributeError(name)
+  section = self.providers.get(name, pipeline.section_for(name))
+  if section in unparsed:
+   self.parse(section)
+   if name in self.__dict__:
+    return self.__dict__[name]
+  for section in [section for section in unparsed if section not in self.seen]:
+   self.parse(section)
+   if name in self.__dict__:
+    return self.__dict__[name]
+  raise AttributeError(name)
 
-voyager.write_item_descriptions(ff4)
+# Runs the whole Voyager pipeline on one rom and saves the result.
+# Any of the steps (see pipeline.py) can be skipped by leaving them out
+# of "steps".
+# This is also what each worker runs in batch mode (see batch.py), so
+# a batch output is always identical to patching that rom on its own.
+# If the same rom has already been patched with the same steps (and the
+# same version of Voyager), the result comes straight from the cache.
+# If the output file name ends in .ips or .bps, only the changes get
+# saved, as a patch against the input rom.
+# Passing a profiler (see instrument.py) measures every step and phase,
+# and passing a journal (see journal.py) records everything they change.
+# A journal needs the steps to actually run, so it skips the cache.
+#
+# The input rom is memory mapped (see romimage.py) rather than read in,
+# and the same mapping is what the steps work on, so only the pages
+# that change ever get copied, and saving streams the rest straight
+# from the input file to the output. That goes for cache hits and
+# misses alike.
+def patch_rom(inputfile, outputfile, patchpath = patchpath, steps = pipeline.STEP_NAMES, use_cache = True, profiler = None, journal = None):
+ if journal is not None:
+  use_cache = False
+ with romimage.RomImage(inputfile) as source:
+  image = None
+  if use_cache:
+   key = cache.result_key(source.map, steps, patchpath)
+   with instrument.measure(profiler, "cache", kind = "phase"):
+    image = cache.lookup(key, source)
+  if image is not None:
+   save_image(outputfile, source, image)
+   return
 
-ff4.write("magic")
-ff4.write("gear")
-ff4.write("party")
-ff4.write("combat")
-ff4.write("tilemaps")
-ff4.write("overworld")
-ff4.write("maps", False)
+  with instrument.measure(profiler, "read", kind = "phase"):
+   ff4 = load_rom(inputfile, pipeline.sections_needed(pipeline.plan(steps)), source)
+  pipeline.run(ff4, steps, patchpath, profiler, journal = journal)
+  del ff4
 
-# Only write the triggers we changed.
-# Since we're not changing the number of triggers, 
-#  the pointers can be left alone.
-trigger_address = ff4.rom.TRIGGER_DATA_START
-for map in ff4.maps:
- for trigger in map.triggers:
-  if trigger in changed_treasures or map == ff4.KAIPO_TOWN:
-   trigger.write(ff4.rom, trigger_address)
-  trigger_address += 5
+  # The steps wrote straight into the image of the input, so only the
+  # pages they touched need comparing for the cache.
+  if use_cache:
+   cache.store(key, len(source), source.runs())
+  with instrument.measure(profiler, "save", kind = "phase"):
+   save_image(outputfile, source, source)
 
-ff4.save(outputfile)
+# Patches a rom given as bytes and returns the output (a rom, or an
+# IPS/BPS patch if "format" says so) as bytes. Gamingway only opens roms
+# from disk, so this goes through a temporary folder.
+def patch_bytes(source, steps = pipeline.STEP_NAMES, format = "rom", patchpath = patchpath, use_cache = True):
+ with tempfile.TemporaryDirectory() as folder:
+  inputfile = os.path.join(folder, "input.smc")
+  outputfile = os.path.join(folder, "output." + ("smc" if format == "rom" else format))
+  with open(inputfile, "wb") as file:
+   file.write(source)
+  patch_rom(inputfile, outputfile, patchpath, steps, use_cache)
+  with open(outputfile, "rb") as file:
+   return file.read()
+
+# Saves a finished rom, or just a patch of its changes.
+def save_result(outputfile, source, result):
+ if ips.is_patch_file(outputfile):
+  result = ips.make_patch(source, result, outputfile)
+ with open(outputfile, "wb") as file:
+  file.write(result)
+
+# Same as save_result, for a patched RomImage on top of the input. A
+# full rom gets streamed out page by page.
+def save_image(outputfile, source, image):
+ if ips.is_patch_file(outputfile):
+  save_result(outputfile, source.map, bytes(image))
+ else:
+  image.save(outputfile)
+
+if __name__ == "__main__":
+ args = sys.argv
+ if len(args) < 2:
+  inputfile = "../Resources/fe.smc"
+ else:
+  inputfile = args[1]
+ if len(args) < 3:
+  outputfile = "../game.smc"
+ else:
+  print(len(args))
+  outputfile = args[2]
+
+ patch_rom(inputfile, outputfile)
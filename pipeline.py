@@ -0,0 +1,210 @@
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+import ips
+import voyager
+from journal import record as record_changes
+
+# The Voyager customizations as a list of declared steps. Each step
+# says which parts of the rom it reads and writes and which steps it
+# has to come after, and the scheduler (see plan) works out a running
+# order from that instead of relying on the order of the calls in
+# patch.py. Steps that take the patch folder as an argument say so
+# with patchpath = True.
+#
+# Besides the gamingway sections (magic, gear, party, ...), a step can
+# also use:
+#  * "descriptions" - the item description block
+#  * "triggers"     - the individual map triggers
+#  * "rom"          - raw bytes poked directly into the rom
+#  * "ips"          - the IPS patches in the patch folder
+#  * "events"       - the event scripts
+
+class Step:
+ def __init__(self, name, function, reads = [], writes = [], after = [], patchpath = False):
+  self.name = name
+  self.function = function
+  self.reads = set(reads)
+  self.writes = set(writes)
+  self.after = list(after)
+  self.patchpath = patchpath
+
+ def run(self, ff4, patchpath):
+  if self.patchpath:
+   self.function(ff4, patchpath)
+  else:
+   self.function(ff4)
+
+STEPS = [
+ Step("fix_sort_position", voyager.fix_sort_position,
+  writes = ["rom"]),
+ Step("rename_spells", voyager.rename_spells,
+  reads = ["magic", "descriptions"], writes = ["magic", "descriptions"]),
+ Step("customize_spell_effects", voyager.customize_spell_effects,
+  reads = ["magic", "gear"], writes = ["magic"]),
+ Step("customize_spellbooks", voyager.customize_spellbooks,
+  reads = ["magic"], writes = ["magic"]),
+ Step("rename_equipment", voyager.rename_equipment,
+  reads = ["gear", "descriptions"], writes = ["gear", "descriptions"]),
+
+ # Porom's hammers pick up the hammer symbol from the renamed items.
+ Step("customize_equips", voyager.customize_equips,
+  reads = ["gear"], writes = ["gear"], after = ["rename_equipment"]),
+ Step("customize_equipment", voyager.customize_equipment,
+  reads = ["gear", "descriptions"], writes = ["gear", "descriptions"], after = ["rename_equipment"]),
+ Step("customize_commands", voyager.customize_commands,
+  reads = ["magic", "gear", "party", "ips"], writes = ["magic", "party", "combat", "rom"], patchpath = True),
+
+ # The starting spells are worked out from the new spell progression.
+ Step("consistent_starting_levels", voyager.consistent_starting_levels,
+  reads = ["party", "magic"], writes = ["party", "magic"], after = ["customize_spellbooks"]),
+ Step("customize_levelups", voyager.customize_levelups,
+  reads = ["party"], writes = ["party"]),
+ Step("customize_monsters", voyager.customize_monsters,
+  reads = ["combat"], writes = ["combat"]),
+ Step("customize_maps", voyager.customize_maps,
+  reads = ["maps", "overworld", "triggers", "ips"], writes = ["maps", "overworld", "triggers", "rom"], patchpath = True),
+ Step("convert_jitems", voyager.convert_jitems,
+  reads = ["gear", "triggers"], writes = ["triggers"]),
+]
+
+STEP_NAMES = [step.name for step in STEPS]
+
+# Puts the enabled steps in a running order. A step runs after every
+# step named in its "after" list, wherever that step is in STEPS. On top
+# of that, two steps that touch the same part of the rom (one writes
+# something the other reads or writes) keep their STEPS order, unless
+# the "after" lists (directly or through other steps) already say
+# otherwise. Steps that have nothing to do with each other are put in
+# STEPS order, so the plan is always the same for the same selection.
+# Disabled steps are simply left out; an "after" on a disabled step
+# just doesn't apply. Steps that end up having to wait for each other
+# raise a ValueError.
+def plan(enabled = STEP_NAMES):
+ steps = [step for step in STEPS if step.name in enabled]
+ position = {step.name: index for index, step in enumerate(steps)}
+ before = [set(position[name] for name in step.after if name in position) for step in steps]
+
+ # Whether "first" already has to run before "second", going by the
+ # orderings worked out so far.
+ def runs_before(first, second):
+  pending = [second]
+  seen = set()
+  while len(pending) > 0:
+   index = pending.pop()
+   if index == first:
+    return True
+   if index not in seen:
+    seen.add(index)
+    pending += before[index]
+  return False
+
+ for index, step in enumerate(steps):
+  for earlier in range(index):
+   if steps[earlier].writes & (step.reads | step.writes) or step.writes & steps[earlier].reads:
+    if not runs_before(index, earlier):
+     before[index].add(earlier)
+
+ dependents = [[] for step in steps]
+ waiting = [len(before[index]) for index in range(len(steps))]
+ for index in range(len(steps)):
+  for earlier in before[index]:
+   dependents[earlier].append(index)
+ ready = [index for index in range(len(steps)) if waiting[index] == 0]
+ heapq.heapify(ready)
+ order = []
+ while len(ready) > 0:
+  index = heapq.heappop(ready)
+  order.append(steps[index])
+  for later in dependents[index]:
+   waiting[later] -= 1
+   if waiting[later] == 0:
+    heapq.heappush(ready, later)
+ if len(order) < len(steps):
+  stuck = [step.name for index, step in enumerate(steps) if waiting[index] > 0]
+  raise ValueError("These steps are each waiting on another: {}".format(", ".join(stuck)))
+ return order
+
+# The sections gamingway can parse separately, in the order to parse
+# them in. Triggers are parsed as part of the maps, and the item
+# descriptions need the item list from the gear.
+PARSE_SECTIONS = ["magic", "gear", "party", "combat", "maps", "tilemaps", "overworld", "events"]
+
+# The sections that provide the rom's main lists, and the endings of
+# names that always belong to one section, so a lazily parsed rom can
+# go straight to the right one. Anything else is learned as sections
+# get parsed (see patch.LazyFF4Rom).
+SECTION_ATTRIBUTES = {
+ "spells": "magic",
+ "items": "gear",
+ "equips": "gear",
+ "maps": "maps",
+ "tilemaps": "tilemaps",
+ "overworld": "overworld",
+ "events": "events"
+}
+SECTION_SUFFIXES = {
+ "_SPELL": "magic"
+}
+
+# The section expected to provide the given attribute, or None.
+def section_for(name):
+ if name in SECTION_ATTRIBUTES:
+  return SECTION_ATTRIBUTES[name]
+ for suffix, section in SECTION_SUFFIXES.items():
+  if name.endswith(suffix):
+   return section
+ return None
+
+# Attributes Voyager keeps its own bookkeeping in. Asking whether these
+# exist shouldn't make a lazily parsed rom go parse everything.
+VOYAGER_STATE = ["dirty_sections", "trigger_table", "description_block", "event_decoder"]
+
+# Works out which sections the planned steps need parsed.
+def sections_needed(steps):
+ needed = set()
+ for step in steps:
+  needed |= step.reads | step.writes
+ if "triggers" in needed:
+  needed.add("maps")
+ if "descriptions" in needed:
+  needed.add("gear")
+ return [section for section in PARSE_SECTIONS if section in needed]
+
+def uses(steps, part):
+ return any(part in step.reads or part in step.writes for step in steps)
+
+# Does the read-only groundwork the planned steps need (decoding the
+# item descriptions and events, parsing the IPS patches) side by side
+# before any step runs, since none of it depends on the rest.
+def prepare(ff4, steps, patchpath):
+ jobs = []
+ if uses(steps, "descriptions"):
+  jobs.append((voyager.read_item_descriptions, ff4))
+ if uses(steps, "ips"):
+  jobs.append((ips.preload, patchpath))
+ if uses(steps, "events"):
+  import eventdecoder
+  jobs.append((eventdecoder.load, ff4))
+ with ThreadPoolExecutor(max(len(jobs), 1)) as pool:
+  for future in [pool.submit(function, argument) for function, argument in jobs]:
+   future.result()
+
+# Runs the enabled steps and writes back whatever they changed. If a
+# profiler (see instrument.py) is given, each step and phase is
+# measured, and if a journal (see journal.py) is given, everything each
+# step and phase changes gets recorded in it. Pass prepared = True if
+# prepare() has already been run on this rom for (at least) these steps.
+def run(ff4, enabled = STEP_NAMES, patchpath = ips.BUNDLED_FOLDER, profiler = None, prepared = False, journal = None):
+ steps = plan(enabled)
+ if not prepared:
+  with instrument.measure(profiler, "prepare", kind = "phase"):
+   prepare(ff4, steps, patchpath)
+ for step in steps:
+  with instrument.measure(profiler, step.name, ff4.rom.data), record_changes(journal, step.name, ff4):
+   step.run(ff4, patchpath)
+ with instrument.measure(profiler, "write", ff4.rom.data, kind = "phase"), record_changes(journal, "write", ff4):
+  if uses(steps, "descriptions"):
+   voyager.write_item_descriptions(ff4)
+  voyager.write_changes(ff4)
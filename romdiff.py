@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+
+import delta
+import ips
+import pipeline
+import voyager
+
+# Compares an input rom with a patched one and lists what changed, as
+# ranges of bytes labelled with the part of the rom they're in and the
+# steps that could have written them. Usage:
+#
+#   python romdiff.py <old rom> <new rom> [--journal FILE] [--json]
+#
+# The comparison itself is delta.ranges, which works on whole NumPy
+# arrays. Differences closer together than --gap bytes are merged into
+# one range.
+#
+# The regions come from:
+#  * the raw addresses Voyager pokes itself (sort positions, Pray, etc)
+#  * the item description block
+#  * the records of the bundled IPS patches, if --patchpath is given
+#  * the table addresses gamingway knows about (triggers, spells, ...),
+#    if gamingway is installed. Only their starts are known, so each one
+#    is taken to run up to the next; data that happens to sit in
+#    between gets labelled as part of the table before it.
+#
+# Without a journal, all there is to go on is which steps declare that
+# they write each region (see pipeline.py), so every change is listed
+# with its "possible writers", which for a busy part like the magic can
+# be several steps. If the journal of the run is given (see journal.py),
+# "steps" says which steps actually wrote each range: the ones whose raw
+# writes overlap it or, for the sections gamingway writes back at the
+# end, the ones that changed fields in that part of the rom.
+
+GAP = 8
+
+# The addresses Voyager writes to directly, and which step does it.
+FIXED_REGIONS = [
+ ("sort position code", 0x4F2, 0x501, ["fix_sort_position"]),
+ ("Bear command spell", 0x1E897, 0x1E898, ["customize_commands"]),
+ ("Bear command message", 0x1E8A5, 0x1E8A6, ["customize_commands"]),
+ ("Pray success rate", 0x1EA56, 0x1EA57, ["customize_commands"]),
+ ("Pray spell", 0x1EA64, 0x1EA65, ["customize_commands"]),
+ ("Recall spells", 0x1EC26, 0x1EC26 + 8 * 8, ["customize_commands"])
+]
+
+# Which step applies each of the bundled IPS patches.
+IPS_STEPS = {
+ "Black Chocobo Fix.ips": "customize_maps",
+ "Custom Salve.ips": "customize_commands",
+ "Dark Wave Fix.ips": "customize_commands"
+}
+
+ITEM_COUNT = 0x100
+
+# Words in gamingway's table names, and the part of the rom (as used in
+# pipeline.py) the table belongs to.
+TABLE_PARTS = [
+ ("TRIGGER", "triggers"),
+ ("EVENT", "events"),
+ ("SPELL", "magic"),
+ ("MAGIC", "magic"),
+ ("ITEM", "gear"),
+ ("WEAPON", "gear"),
+ ("ARMOR", "gear"),
+ ("MONSTER", "combat"),
+ ("COMMAND", "combat"),
+ ("CHARACTER", "party"),
+ ("LEVEL", "party"),
+ ("TILEMAP", "tilemaps"),
+ ("OVERWORLD", "overworld"),
+ ("MAP", "maps")
+]
+
+class Region:
+ def __init__(self, name, start, end, steps, part = None):
+  self.name = name
+  self.start = start
+  self.end = end
+  self.steps = steps
+  self.part = part
+
+# The part of the rom (as used in pipeline.py) a gamingway table or
+# attribute name belongs to, going by the words in it.
+def part_of(name):
+ name = name.upper()
+ for word, part in TABLE_PARTS:
+  if word in name:
+   return part
+ return None
+
+# The steps that write the given part of the rom.
+def writers(part):
+ return [step.name for step in pipeline.STEPS if part in step.writes]
+
+# Builds the list of known regions. "data" (the input rom) is needed to
+# place the IPS records, which depend on whether the rom has a header.
+def regions(ff4 = None, data = None, patchpath = None):
+ result = [Region(name, start, end, steps) for name, start, end, steps in FIXED_REGIONS]
+ items = len(ff4.items) if ff4 is not None and hasattr(ff4, "items") else ITEM_COUNT
+ result.append(Region("item descriptions", voyager.DESCRIPTIONS_START, voyager.DESCRIPTIONS_START + items * voyager.DESCRIPTION_SIZE, writers("descriptions"), "descriptions"))
+
+ if patchpath is not None and data is not None:
+  shift = ips.header_size(data)
+  for filename, header in ips.BUNDLED.items():
+   path = os.path.join(patchpath, filename)
+   if os.path.exists(path):
+    for offset, chunk in ips.load_patch(path, header).records:
+     result.append(Region("IPS " + filename, offset + shift, offset + shift + len(chunk), [IPS_STEPS[filename]]))
+
+ # Each of gamingway's tables is taken to run up to where the next one
+ # starts.
+ if ff4 is not None:
+  starts = []
+  for name in dir(ff4.rom):
+   if name.endswith("_START") and isinstance(getattr(ff4.rom, name), int):
+    starts.append((getattr(ff4.rom, name), name[:-len("_START")]))
+  starts.sort()
+  for index, (start, name) in enumerate(starts):
+   end = starts[index + 1][0] if index + 1 < len(starts) else start + 1
+   part = part_of(name)
+   steps = writers(part) if part is not None else []
+   result.append(Region(name.lower().replace("_", " "), start, max(end, start + 1), steps, part))
+ return result
+
+# Labels each changed range with the regions it touches and the steps
+# that could have written it, and (given a journal) the ones that did.
+def describe(old, new, known = None, changes = None, gap = GAP):
+ if known is None:
+  known = regions(data = old)
+ known = sorted(known, key = lambda region: region.start)
+ result = []
+ for start, end in delta.ranges(old, new, gap):
+  names = []
+  parts = []
+  possible = []
+  for region in known:
+   if region.start >= end:
+    break
+   if region.end > start:
+    if region.name not in names:
+     names.append(region.name)
+    if region.part is not None and region.part not in parts:
+     parts.append(region.part)
+    possible += [step for step in region.steps if step not in possible]
+  change = {"start": start, "end": end, "size": end - start, "regions": names, "possible_writers": possible}
+  if changes is not None:
+   change["steps"] = journal_writers(changes, start, end, parts)
+  result.append(change)
+ return result
+
+# The steps the journal says wrote the given range. The sections
+# gamingway writes back all show up as raw writes of the "write" phase,
+# so that's narrowed down to the steps that changed fields in the same
+# parts of the rom, where there are any.
+def journal_writers(changes, start, end, parts):
+ steps = []
+ for step, address, before, after in changes.writes:
+  if address < end and address + len(after) > start and step not in steps:
+   steps.append(step)
+ if "write" in steps:
+  changed = []
+  for step, path, before, after in changes.fields:
+   if step != "write" and step not in changed and part_of(str(path[0])) in parts:
+    changed.append(step)
+  if len(changed) > 0:
+   steps.remove("write")
+   steps += [step for step in changed if step not in steps]
+ return steps
+
+def format_change(change):
+ if "steps" in change:
+  writers = ", ".join(change["steps"]) or "?"
+ else:
+  writers = "maybe " + " or ".join(change["possible_writers"]) if len(change["possible_writers"]) > 0 else "?"
+ return "{:06X}-{:06X} {:6} bytes  {:<32} {}".format(change["start"], change["end"] - 1, change["size"], ", ".join(change["regions"]) or "?", writers)
+
+if __name__ == "__main__":
+ parser = argparse.ArgumentParser(description = "Show what changed between an input rom and a patched one.")
+ parser.add_argument("old", help = "the input rom")
+ parser.add_argument("new", help = "the patched rom")
+ parser.add_argument("--journal", default = None, help = "the journal saved while patching, to tell which steps actually wrote each change")
+ parser.add_argument("--patchpath", default = None, help = "folder holding the IPS patches, to label their records")
+ parser.add_argument("--gap", type = int, default = GAP, help = "merge differences closer together than this")
+ parser.add_argument("--json", action = "store_true", help = "print the changes as JSON")
+ args = parser.parse_args()
+
+ with open(args.old, "rb") as file:
+  old = file.read()
+ with open(args.new, "rb") as file:
+  new = file.read()
+
+ # Gamingway's table addresses are only used if it's installed.
+ ff4 = None
+ try:
+  import patch
+  ff4 = patch.FF4Rom(args.old)
+ except ImportError:
+  pass
+ changes = None
+ if args.journal is not None:
+  import journal
+  changes = journal.load(args.journal)
+
+ result = describe(old, new, regions(ff4, old, args.patchpath), changes, args.gap)
+ if args.json:
+  print(json.dumps(result, indent = 1))
+ else:
+  for change in result:
+   print(format_change(change))
+  print("{} ranges, {} bytes changed".format(len(result), sum(change["size"] for change in result)))
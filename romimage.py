@@ -0,0 +1,179 @@
+import mmap
+import os
+
+import delta
+
+# A rom image backed by a read-only memory map of the input file, with
+# a copy-on-write overlay on top. Reading goes straight to the mapping,
+# and only the pages that actually get written to are copied into
+# memory. Saving streams the untouched pages from the mapping into the
+# output file, so a rom with a few hundred changed bytes never needs a
+# full copy of itself in memory.
+#
+# It supports the parts of the bytearray interface the patching code
+# (and gamingway) uses: len(), reading and writing single bytes or
+# (step 1) slices, extend(), and deleting from some offset to the end,
+# so it can stand in for a parsed rom's data.
+
+PAGE_SIZE = 0x1000
+
+class RomImage:
+ def __init__(self, filename):
+  self.file = open(filename, "rb")
+  if self.file.seek(0, 2) > 0:
+   self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+  else:
+   self.map = b""
+  self.pages = {}
+  self.size = len(self.map)
+
+ def close(self):
+  if isinstance(self.map, mmap.mmap):
+   self.map.close()
+  self.file.close()
+
+ def __enter__(self):
+  return self
+
+ def __exit__(self, *exception):
+  self.close()
+
+ def __len__(self):
+  return self.size
+
+ # Returns the writable copy of a page, making it on first use.
+ def page(self, number):
+  if number not in self.pages:
+   start = number * PAGE_SIZE
+   page = bytearray(self.map[start:start + PAGE_SIZE])
+   if len(page) < PAGE_SIZE:
+    page += bytes(PAGE_SIZE - len(page))
+   self.pages[number] = page
+  return self.pages[number]
+
+ def range(self, key):
+  start, stop, step = key.indices(self.size)
+  if step != 1:
+   raise ValueError("RomImage slices can't have a step.")
+  return start, max(start, stop)
+
+ def read(self, start, stop):
+  result = bytearray()
+  position = start
+  while position < stop:
+   number = position // PAGE_SIZE
+   offset = position - number * PAGE_SIZE
+   end = min(stop, (number + 1) * PAGE_SIZE)
+   if number in self.pages:
+    result += self.pages[number][offset:offset + end - position]
+   elif end <= len(self.map):
+    result += self.map[position:end]
+   else:
+    result += bytes(end - position)
+   position = end
+  return bytes(result)
+
+ def write(self, start, data):
+  position = start
+  index = 0
+  while index < len(data):
+   number = position // PAGE_SIZE
+   offset = position - number * PAGE_SIZE
+   count = min(len(data) - index, PAGE_SIZE - offset)
+   self.page(number)[offset:offset + count] = data[index:index + count]
+   position += count
+   index += count
+
+ def __getitem__(self, key):
+  if isinstance(key, slice):
+   start, stop = self.range(key)
+   return self.read(start, stop)
+  if key < 0:
+   key += self.size
+  if key < 0 or key >= self.size:
+   raise IndexError("RomImage index out of range")
+  number = key // PAGE_SIZE
+  if number in self.pages:
+   return self.pages[number][key - number * PAGE_SIZE]
+  return self.map[key]
+
+ def __setitem__(self, key, value):
+  if isinstance(key, slice):
+   start, stop = self.range(key)
+   value = bytes(value)
+   if len(value) != stop - start:
+    raise ValueError("RomImage slices can't change size; use extend().")
+   self.write(start, value)
+  else:
+   if key < 0:
+    key += self.size
+   if key < 0 or key >= self.size:
+    raise IndexError("RomImage index out of range")
+   self.write(key, bytes([value]))
+
+ def extend(self, data):
+  start = self.size
+  self.size += len(data)
+  self.write(start, bytes(data))
+
+ # Only truncating (deleting everything from some offset on) is
+ # supported.
+ def __delitem__(self, key):
+  start, stop = self.range(key)
+  if stop != self.size:
+   raise ValueError("RomImage can only be truncated.")
+  self.size = start
+  for number in [number for number in self.pages if number * PAGE_SIZE >= start]:
+   del self.pages[number]
+  if start % PAGE_SIZE != 0:
+   page = self.page(start // PAGE_SIZE)
+   page[start % PAGE_SIZE:] = bytes(PAGE_SIZE - start % PAGE_SIZE)
+
+ def __bytes__(self):
+  return self.read(0, self.size)
+
+ # Returns the runs of bytes (see delta.py) that differ from the mapped
+ # file. Only the pages that have been written to get compared.
+ def runs(self):
+  result = []
+  for number in sorted(self.pages):
+   start = number * PAGE_SIZE
+   if start >= self.size:
+    continue
+   end = min(start + PAGE_SIZE, self.size)
+   original = self.map[start:min(end, len(self.map))]
+   for offset, chunk in delta.diff(original, self.pages[number][0:end - start]):
+    offset += start
+    if len(result) > 0 and result[-1][0] + len(result[-1][1]) == offset:
+     result[-1] = (result[-1][0], result[-1][1] + chunk)
+    else:
+     result.append((offset, chunk))
+  return result
+
+ # Writes the image to a file, copying untouched pages straight from
+ # the mapping. Saving over the input file itself only writes the pages
+ # that changed.
+ def save(self, filename):
+  if os.path.exists(filename) and os.path.samefile(filename, self.file.name):
+   self.save_in_place()
+   return
+  with open(filename, "wb") as file:
+   for start in range(0, self.size, PAGE_SIZE):
+    number = start // PAGE_SIZE
+    end = min(start + PAGE_SIZE, self.size)
+    if number in self.pages:
+     file.write(self.pages[number][0:end - start])
+    elif end <= len(self.map):
+     file.write(self.map[start:end])
+    else:
+     file.write(self.read(start, end))
+
+ def save_in_place(self):
+  with open(self.file.name, "r+b") as file:
+   for number in sorted(self.pages):
+    start = number * PAGE_SIZE
+    if start < self.size:
+     file.seek(start)
+     file.write(self.pages[number][0:min(PAGE_SIZE, self.size - start)])
+   if self.size != len(self.map):
+    file.truncate(self.size)
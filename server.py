@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import socketserver
+import stat
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import ips
+import patch
+import pipeline
+
+# A long running patch server, so that a frontend generating seeds
+# doesn't pay for starting Python, importing gamingway and reading the
+# IPS patches on every single rom. Usage:
+#
+#   python server.py [--port 8642] [--workers N]
+#   python server.py --socket /tmp/voyager.sock
+#
+# It speaks plain HTTP, on localhost or on a Unix socket:
+#  * GET /steps lists the steps that can be selected
+#  * POST /patch with the input rom as the request body patches it and
+#    returns the result. "steps" (a comma separated list, all of them by
+#    default) picks the steps to run, and "format" (rom, ips or bps)
+#    whether to return the whole rom or just a patch, e.g.
+#      curl --data-binary @fe.smc "localhost:8642/patch?format=ips" -o out.ips
+#
+# Requests are handled concurrently, with the actual patching spread
+# over a pool of worker processes that each load everything once when
+# they start and then stay up. Results still go through the result
+# cache (see cache.py), so asking for the same rom twice is instant.
+
+PORT = 8642
+FORMATS = ["rom", "ips", "bps"]
+
+# Anything bigger than this can't be a rom.
+MAX_ROM_SIZE = 16 * 1024 * 1024
+
+# Runs once in each worker process when it starts.
+def warm_up(patchpath):
+ ips.preload(patchpath)
+
+class PatchHandler(BaseHTTPRequestHandler):
+ def do_GET(self):
+  if urlparse(self.path).path == "/steps":
+   self.reply(200, json.dumps(pipeline.STEP_NAMES).encode(), "application/json")
+  else:
+   self.reply(404, b"Not found.\n")
+
+ def do_POST(self):
+  url = urlparse(self.path)
+  if url.path != "/patch":
+   self.reply(404, b"Not found.\n")
+   return
+  query = parse_qs(url.query)
+  steps = pipeline.STEP_NAMES
+  if "steps" in query:
+   steps = [name for name in query["steps"][0].split(",") if len(name) > 0]
+  unknown = [name for name in steps if name not in pipeline.STEP_NAMES]
+  if len(unknown) > 0:
+   self.reply(400, "Unknown steps: {}\n".format(", ".join(unknown)).encode())
+   return
+  format = query.get("format", ["rom"])[0]
+  if format not in FORMATS:
+   self.reply(400, "Unknown format: {}\n".format(format).encode())
+   return
+  try:
+   length = int(self.headers.get("Content-Length", 0))
+  except ValueError:
+   self.reply(400, b"Bad Content-Length.\n")
+   return
+  if length <= 0 or length > MAX_ROM_SIZE:
+   self.reply(413 if length > 0 else 400, b"Send the input rom as the request body.\n")
+   return
+  source = self.rfile.read(length)
+
+  try:
+   result = self.server.pool.submit(patch.patch_bytes, source, steps, format, self.server.patchpath).result()
+  except Exception as error:
+   self.reply(500, "{}: {}\n".format(type(error).__name__, error).encode())
+   return
+  self.reply(200, result)
+
+ def reply(self, status, body, content_type = "application/octet-stream"):
+  if status != 200:
+   content_type = "text/plain"
+  self.send_response(status)
+  self.send_header("Content-Type", content_type)
+  self.send_header("Content-Length", str(len(body)))
+  self.end_headers()
+  self.wfile.write(body)
+
+ # Unix socket clients don't have an address.
+ def address_string(self):
+  if isinstance(self.client_address, tuple):
+   return self.client_address[0]
+  return "local"
+
+class PatchServer(ThreadingHTTPServer):
+ daemon_threads = True
+
+class UnixPatchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+ daemon_threads = True
+
+# Removes the Unix socket left behind by an earlier run. Anything else
+# at that path is left alone, since it's not ours to delete.
+def remove_socket(socket):
+ try:
+  mode = os.stat(socket).st_mode
+ except FileNotFoundError:
+  return
+ if not stat.S_ISSOCK(mode):
+  raise FileExistsError("{} exists and isn't a socket.".format(socket))
+ os.remove(socket)
+
+# Serves until interrupted. If "socket" is given, the server listens on
+# that Unix socket instead of on localhost.
+def serve(port = PORT, socket = None, workers = None, patchpath = ips.BUNDLED_FOLDER):
+ if socket is not None:
+  remove_socket(socket)
+  server = UnixPatchServer(socket, PatchHandler)
+ else:
+  server = PatchServer(("127.0.0.1", port), PatchHandler)
+ server.patchpath = patchpath
+ with ProcessPoolExecutor(workers, initializer = warm_up, initargs = (patchpath,)) as server.pool:
+  try:
+   server.serve_forever()
+  except KeyboardInterrupt:
+   pass
+  finally:
+   server.server_close()
+   if socket is not None:
+    remove_socket(socket)
+
+if __name__ == "__main__":
+ parser = argparse.ArgumentParser(description = "Serve Voyager patches over HTTP.")
+ parser.add_argument("--port", type = int, default = PORT, help = "localhost port to listen on")
+ parser.add_argument("--socket", default = None, help = "listen on this Unix socket instead")
+ parser.add_argument("--workers", type = int, default = None, help = "number of worker processes (default: one per CPU)")
+ parser.add_argument("--patchpath", default = ips.BUNDLED_FOLDER, help = "folder holding the IPS patches")
+ args = parser.parse_args()
+
+ serve(args.port, args.socket, args.workers, args.patchpath)
@@ -40,22 +40,7 @@ changed_treasures = voyager.convert_jitems(ff4)
 
 voyager.write_item_descriptions(ff4)
 
-ff4.write("magic")
-ff4.write("gear")
-ff4.write("party")
-ff4.write("combat")
-ff4.write("tilemaps")
-ff4.write("overworld")
-ff4.write("maps", False)
-
-# Only write the triggers we changed.
-# Since we're not changing the number of triggers, 
-#  the pointers can be left alone.
-trigger_address = ff4.rom.TRIGGER_DATA_START
-for map in ff4.maps:
- for trigger in map.triggers:
-  if trigger in changed_treasures:
-   trigger.write(ff4.rom, trigger_address)
-  trigger_address += 5
+# Only write the triggers we changed, as the stable build always has.
+voyager.write_changes(ff4, changed_treasures)
 
 ff4.save(outputfile)
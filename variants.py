@@ -0,0 +1,152 @@
+import argparse
+import copy
+import os
+import sys
+import traceback
+
+import ips
+import patch
+import pipeline
+import romimage
+
+# Makes several variants of the same rom (say, with and without
+# customize_commands) while only parsing it once. Usage:
+#
+#   python variants.py <input rom> <output folder> name=steps [name=steps ...]
+#
+# Each variant is a name and a comma separated list of steps. Steps
+# starting with "-" are left out instead, starting from the full list,
+# so "nocommands=-customize_commands" is everything but the commands.
+# Each variant is saved as <name>.smc in the output folder, or as a
+# patch with --format ips or --format bps.
+#
+# The rom is parsed (and the descriptions, events and IPS patches the
+# steps need are decoded) once up front. Where os.fork is available,
+# each variant then runs in a forked child, which starts out sharing the
+# parsed rom with the parent and only copies what its steps change.
+# Elsewhere (Windows) each variant gets a deep copy of the parsed rom
+# instead, which is still a lot cheaper than parsing it again.
+
+# Turns "name=step,step" into (name, list of steps).
+def parse_variant(text):
+ name, _, selection = text.partition("=")
+ names = [step for step in selection.split(",") if len(step) > 0]
+ removed = [step[1:] for step in names if step.startswith("-")]
+ if len(removed) == len(names):
+  steps = list(pipeline.STEP_NAMES)
+ else:
+  steps = [step for step in names if not step.startswith("-")]
+ steps = [step for step in steps if step not in removed]
+ unknown = [step for step in steps + removed if step not in pipeline.STEP_NAMES]
+ if len(name) == 0 or len(unknown) > 0:
+  raise ValueError("Bad variant {!r}.".format(text))
+ return name, steps
+
+# Runs one variant's steps on an already parsed rom and saves it.
+def make_variant(ff4, source, steps, outputfile, patchpath):
+ pipeline.run(ff4, steps, patchpath, prepared = True)
+ if not ips.is_patch_file(outputfile):
+  ff4.save(outputfile)
+  return
+ romfile = outputfile + ".tmp"
+ ff4.save(romfile)
+ with romimage.RomImage(romfile) as result:
+  patch.save_result(outputfile, source, result.map)
+ os.remove(romfile)
+
+# Runs every variant in a forked child, at most "workers" at a time.
+def run_forked(ff4, source, jobs, patchpath, workers):
+ results = {}
+ running = {}
+
+ def reap():
+  pid, status = os.waitpid(-1, 0)
+  if pid in running:
+   results[running.pop(pid)] = os.waitstatus_to_exitcode(status) == 0
+
+ for name, steps, outputfile in jobs:
+  while len(running) >= workers:
+   reap()
+  sys.stdout.flush()
+  sys.stderr.flush()
+  pid = os.fork()
+  if pid == 0:
+   code = 1
+   try:
+    make_variant(ff4, source, steps, outputfile, patchpath)
+    code = 0
+   except Exception:
+    traceback.print_exc()
+   finally:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+  running[pid] = name
+ while len(running) > 0:
+  reap()
+ return results
+
+# A deep copy of a parsed rom. The description block and the
+# descriptions' slices of it are read-only views of an immutable copy
+# (and can't be copied anyway), so the clone just shares them.
+def clone(ff4):
+ memo = {}
+ block = getattr(ff4, "description_block", None)
+ if block is not None:
+  memo[id(block)] = block
+  for item in ff4.items:
+   memo[id(item.description.raw)] = item.description.raw
+ return copy.deepcopy(ff4, memo)
+
+# Runs every variant on its own deep copy of the parsed rom.
+def run_cloned(ff4, source, jobs, patchpath):
+ results = {}
+ for name, steps, outputfile in jobs:
+  try:
+   make_variant(clone(ff4), source, steps, outputfile, patchpath)
+   results[name] = True
+  except Exception:
+   traceback.print_exc()
+   results[name] = False
+ return results
+
+# Makes every variant ({name: steps}) of the input rom and returns one
+# (name, ok, output file) per variant, in the given order.
+def make_variants(inputfile, outputdir, variants, patchpath = ips.BUNDLED_FOLDER, format = "rom", workers = None):
+ if workers is None:
+  workers = os.cpu_count() or 1
+ os.makedirs(outputdir, exist_ok = True)
+ extension = "smc" if format == "rom" else format
+ jobs = [(name, steps, os.path.join(outputdir, "{}.{}".format(name, extension))) for name, steps in variants.items()]
+
+ # Parse and prepare everything any of the variants needs, so the
+ # children don't each have to do it again.
+ planned = pipeline.plan(set(step for steps in variants.values() for step in steps))
+ ff4 = patch.load_rom(inputfile, pipeline.sections_needed(planned))
+ pipeline.prepare(ff4, planned, patchpath)
+
+ with romimage.RomImage(inputfile) as source:
+  if hasattr(os, "fork"):
+   results = run_forked(ff4, source.map, jobs, patchpath, workers)
+  else:
+   results = run_cloned(ff4, source.map, jobs, patchpath)
+ return [(name, results.get(name, False), outputfile) for name, steps, outputfile in jobs]
+
+if __name__ == "__main__":
+ parser = argparse.ArgumentParser(description = "Make several variants of one rom, parsing it only once.")
+ parser.add_argument("inputfile", help = "the rom to patch")
+ parser.add_argument("outputdir", help = "folder to save the variants in")
+ parser.add_argument("variants", nargs = "+", help = "name=step,step,... (or name=-step,... to leave steps out)")
+ parser.add_argument("--format", choices = ["rom", "ips", "bps"], default = "rom", help = "save full roms, or only IPS/BPS patches of the changes")
+ parser.add_argument("--workers", type = int, default = None, help = "number of variants made at once (default: one per CPU)")
+ args = parser.parse_args()
+
+ try:
+  variants = dict(parse_variant(text) for text in args.variants)
+ except ValueError as error:
+  parser.error(str(error))
+ results = make_variants(args.inputfile, args.outputdir, variants, format = args.format, workers = args.workers)
+ for name, ok, outputfile in results:
+  print("{} {} -> {}".format("OK    " if ok else "FAILED", name, outputfile))
+ if not all(ok for name, ok, outputfile in results):
+  raise SystemExit(1)
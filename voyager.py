@@ -1,3 +1,181 @@
+import json
+import re
+
+import cache
+import dungeon
+import grid
+import ips
+
+# Gamingway writes the rom back one "section" at a time (magic, gear,
+# party, etc). Rather than rewriting every section on save, each
+# customization records which sections it actually changed, and
+# write_changes only writes those back.
+SECTIONS = ["magic", "gear", "party", "combat", "tilemaps", "overworld", "maps"]
+
+def mark_dirty(ff4, *sections):
+ if not hasattr(ff4, "dirty_sections"):
+  ff4.dirty_sections = set()
+ ff4.dirty_sections.update(sections)
+
+# Triggers are written back individually rather than as a section,
+# since rewriting the whole maps section would also rewrite every
+# trigger pointer. Each trigger record is 5 bytes, stored map after map,
+# and since we never change the number of triggers, the address of each
+# one only needs to be worked out once.
+#
+# The table also indexes the triggers so they can be looked up without
+# going through the maps' trigger lists: by map and position, by map
+# and type, and (for teleports) by the map they lead to. Marking a
+# trigger as changed re-indexes it, so the index stays in sync as long
+# as every edit goes through mark_triggers.
+TRIGGER_SIZE = 5
+
+class TriggerTable:
+ def __init__(self, ff4):
+  self.addresses = {}
+  self.dirty = {}
+  self.owners = {}
+  self.keys = {}
+  self.index = {}
+  address = ff4.rom.TRIGGER_DATA_START
+  for map in ff4.maps:
+   for trigger in map.triggers:
+    self.addresses[id(trigger)] = address
+    self.owners[id(trigger)] = map
+    self.add(trigger)
+    address += TRIGGER_SIZE
+
+ def address(self, trigger):
+  return self.addresses[id(trigger)]
+
+ # The map the trigger belongs to.
+ def owner(self, trigger):
+  return self.owners[id(trigger)]
+
+ def index_keys(self, trigger):
+  map = id(self.owner(trigger))
+  keys = [("position", map, trigger.x, trigger.y), ("type", map, trigger.type)]
+  if trigger.type == "teleport":
+   keys.append(("destination", trigger.map))
+  return keys
+
+ # Adds a trigger to the index, keeping every list in rom order.
+ def add(self, trigger):
+  keys = self.index_keys(trigger)
+  self.keys[id(trigger)] = keys
+  for key in keys:
+   triggers = self.index.setdefault(key, [])
+   triggers.append(trigger)
+   if len(triggers) > 1 and self.address(triggers[-2]) > self.address(trigger):
+    triggers.sort(key = self.address)
+
+ def remove(self, trigger):
+  for key in self.keys.pop(id(trigger), []):
+   self.index[key] = [other for other in self.index[key] if other is not trigger]
+
+ # Returns the trigger at (x, y) on the given map, or None.
+ def at(self, map, x, y):
+  triggers = self.index.get(("position", id(map), x, y))
+  if not triggers:
+   return None
+  return triggers[0]
+
+ def of_type(self, map, type):
+  return list(self.index.get(("type", id(map), type), []))
+
+ # Every teleport (on any map) that leads to the given map number.
+ def teleports_into(self, destination):
+  return list(self.index.get(("destination", destination), []))
+
+ def mark(self, trigger):
+  self.dirty[id(trigger)] = trigger
+  self.remove(trigger)
+  self.add(trigger)
+
+ def is_dirty(self, trigger):
+  return id(trigger) in self.dirty
+
+ # Writes every changed trigger (or only those of them in "only") back
+ # to its own spot in the rom.
+ def flush(self, rom, only = None):
+  keys = self.dirty
+  if only is not None:
+   keys = set(id(trigger) for trigger in only) & set(self.dirty)
+  for key in sorted(keys, key = lambda key: self.addresses[key]):
+   self.dirty[key].write(rom, self.addresses[key])
+  self.dirty.clear()
+
+def trigger_table(ff4):
+ if not hasattr(ff4, "trigger_table"):
+  ff4.trigger_table = TriggerTable(ff4)
+ return ff4.trigger_table
+
+def mark_triggers(ff4, triggers):
+ table = trigger_table(ff4)
+ for trigger in triggers:
+  table.mark(trigger)
+
+# Writes back only the sections (and triggers) that were marked dirty.
+# If "triggers" is given, only those of the changed triggers are written.
+def write_changes(ff4, triggers = None):
+ dirty = getattr(ff4, "dirty_sections", set())
+ for section in SECTIONS:
+  if section in dirty:
+   if section == "maps":
+    ff4.write("maps", False)
+   else:
+    ff4.write(section)
+
+ # Since we're not changing the number of triggers, the pointers can be
+ # left alone.
+ if hasattr(ff4, "trigger_table"):
+  ff4.trigger_table.flush(ff4.rom, triggers)
+
+# Where the item description block lives, and how it's laid out: one
+# 0x80 byte record per item, made of four 0x20 byte lines, of which the
+# 27 characters from column 2 onward are the actual text.
+DESCRIPTIONS_START = 0x120200
+DESCRIPTION_SIZE = 0x80
+LINE_SIZE = 0x20
+LINE_START = 2
+LINE_LENGTH = 27
+
+# An item's description, decoded from the rom only the first time one of
+# its lines is actually used. It behaves like the list of four strings
+# it used to be, so the customizations can keep indexing into it.
+class Description:
+ def __init__(self, raw, table):
+  self.raw = raw
+  self.table = table
+  self.lines = None
+
+ def decode(self):
+  if self.lines is None:
+   self.lines = []
+   for y in range(4):
+    start = y * LINE_SIZE + LINE_START
+    line = str(self.raw[start:start + LINE_LENGTH], "latin-1")
+    self.lines.append(line.translate(self.table))
+  return self.lines
+
+ def __getitem__(self, index):
+  return self.decode()[index]
+
+ def __setitem__(self, index, value):
+  self.decode()[index] = value
+
+ def __len__(self):
+  return 4
+
+ def __iter__(self):
+  return iter(self.decode())
+
+# Builds the byte -> ASCII translation table for the description text.
+# Gamingway converts text one character at a time, so asking it about
+# each of the 256 possible bytes once gives us the whole mapping.
+def description_table(ff4):
+ return {code: ff4.text.asciitext(chr(code)) for code in range(256)}
+
 def read_item_descriptions(ff4):
 
  # The item descriptions in Free Enterprise are located at 0x120000
@@ -10,36 +188,91 @@ def read_item_descriptions(ff4):
  # elements, racial properties, etc.
  # The character faces representing the equipabilities seem to be
  # auto-generated so that doesn't need updating in the description.
- if len(ff4.rom.data) < 0x120200:
+ if len(ff4.rom.data) < DESCRIPTIONS_START:
   print("ERROR: Not a Free Enterprise rom.")
  else:
-  descriptions = []
+
+  # Grab the whole block in one slice. Each item's description just
+  # points into it, and only gets decoded if something looks at it.
+  end = DESCRIPTIONS_START + len(ff4.items) * DESCRIPTION_SIZE
+  block = memoryview(bytes(ff4.rom.data[DESCRIPTIONS_START:end]))
+  table = description_table(ff4)
   for index, item in enumerate(ff4.items):
-   lines = ["", "", "", ""]
-   for y in range(4):
-    line = ""
-    for x in range(2, 29):
-     line += chr(ff4.rom.data[0x120200 + index * 0x80 + y * 0x20 + x])
-    lines[y] = ff4.text.asciitext(line)
-   item.description = lines
+   raw = block[index * DESCRIPTION_SIZE:(index + 1) * DESCRIPTION_SIZE]
+   item.description = Description(raw, table)
+  ff4.description_block = block
+
+# Encodes a description back into its 0x80 byte record.
+def encode_description(ff4, description):
+ record = bytearray()
+ for y in range(4):
+  line = ff4.text.ff4text(description[y])
+  if len(line) > LINE_LENGTH:
+   line = line[0:LINE_LENGTH]
+  if len(line) < LINE_LENGTH:
+   line = line.ljust(LINE_LENGTH, ff4.text.ff4text(" "))
+  record += bytes([0x00, 0xFA] + ff4.text.to_bytes(line) + [0xFB, 0x00, 0x00])
+ return record
 
 def write_item_descriptions(ff4):
+ end = DESCRIPTIONS_START + len(ff4.items) * DESCRIPTION_SIZE
+ current = memoryview(bytes(ff4.rom.data[DESCRIPTIONS_START:end]))
+
+ # Work out which records actually changed. A description that was
+ # never even decoded and is still in its original slot can't have
+ # changed, so we don't bother encoding it at all.
+ changes = {}
  for index, item in enumerate(ff4.items):
-  if len("".join(item.description).strip()) > 0:
-   for y in range(4):
-    address = 0x120200 + index * 0x80 + y * 0x20
-    line = ff4.text.ff4text(item.description[y])
-    if len(line) > 27:
-     line = line[0:27]
-    if len(line) < 27:
-     line = line.ljust(27, ff4.text.ff4text(" "))
-    bytes = ff4.text.to_bytes(line)
-    bytes = [0x00, 0xFA] + bytes + [0xFB, 0x00, 0x00]
-    ff4.rom.inject(address, bytes)
+  description = item.description
+  original = current[index * DESCRIPTION_SIZE:(index + 1) * DESCRIPTION_SIZE]
+  if isinstance(description, Description) and description.lines is None:
+   if description.raw == original:
+    continue
+  if len("".join(description).strip()) > 0:
+   record = encode_description(ff4, description)
+   if record != original:
+    changes[index] = record
+
+ # Then write everything from the first changed record to the last one
+ # back in one go.
+ if len(changes) > 0:
+  first = min(changes)
+  last = max(changes)
+  buffer = bytearray(current[first * DESCRIPTION_SIZE:(last + 1) * DESCRIPTION_SIZE])
+  for index, record in changes.items():
+   offset = (index - first) * DESCRIPTION_SIZE
+   buffer[offset:offset + DESCRIPTION_SIZE] = record
+  address = DESCRIPTIONS_START + first * DESCRIPTION_SIZE
+  ff4.rom.data[address:address + len(buffer)] = buffer
 
 def display_description(item):
  return "\n".join(item.description)
 
+# Replaces a whole table of {old name: new name} in a single pass over
+# the text instead of doing one str.replace per name. Longer names are
+# matched first, so a name that happens to start with another one
+# (like "Cure1" and "Cure10") is never partially replaced.
+class Renamer:
+ def __init__(self, renames):
+  self.renames = {old: new for old, new in renames.items() if len(old) > 0}
+  names = sorted(self.renames, key = len, reverse = True)
+  self.pattern = re.compile("|".join(re.escape(name) for name in names))
+
+ def apply(self, text):
+  if len(self.renames) == 0:
+   return text
+  return self.pattern.sub(lambda match: self.renames[match.group(0)], text)
+
+# Applies a rename table to every item description. All four lines of a
+# description are scanned together since no name spans a line break.
+def rename_in_descriptions(ff4, renames):
+ renamer = Renamer(renames)
+ for item in ff4.items:
+  lines = renamer.apply("\n".join(item.description)).split("\n")
+  for index in range(4):
+   if item.description[index] != lines[index]:
+    item.description[index] = lines[index]
+
 def rename_spells(ff4):
 
  # In order to rename the spells properly, we need to know both the old
@@ -79,18 +312,18 @@ def rename_spells(ff4):
   ff4.JINN_SPELL:  "[SUM]Ifrit"
  }
  
- # Rename the spells and update the descriptions accordingly.
+ # Update the descriptions first, because in order to do the
+ # replacement, we need to know both the old name and the new name;
+ # replacing the spell names first would cause us to lose the old names.
+ names = {}
+ for spell, newname in renames.items():
+  names.setdefault(spell.name, newname)
+ rename_in_descriptions(ff4, names)
+ 
+ # Once we're done updating the descriptions, we can replace the names.
  for spell, newname in renames.items():
-  
-  # Check the item descriptions first, because in order to do the
-  # replacement, we need to know both the old name and the new name;
-  # replacing the spell name first would cause us to lose the old name.
-  for item in ff4.items:
-   for index in range(4):
-    item.description[index] = item.description[index].replace(spell.name, newname)
-  
-  # Once we're done updating the descriptions, we can replace the name.
   spell.name = newname
+ mark_dirty(ff4, "magic")
 
 # Makes Poisn/Venom like a smaller version of Bio/Virus.
 def customize_venom_spell(ff4):
@@ -101,6 +334,7 @@ def customize_venom_spell(ff4):
  ff4.VENOM_SPELL.hitsboss = True
  ff4.VENOM_SPELL.effect = ff4.config.spell_effects.index("Damage, Sap")
  ff4.VENOM_SPELL.attributes = 0
+ mark_dirty(ff4, "magic")
 
 def venom_virus_shadow_element(ff4):
  ff4.VIRUS_SPELL.attributes = ff4.SHADOWSWORD.attributes
@@ -110,6 +344,7 @@ def venom_virus_shadow_element(ff4):
  # non-elemental; by making it Shadow element, it should probably be
  # slightly stronger because so many things resist/absorb Shadow.
  ff4.VENOM_SPELL.power += 1
+ mark_dirty(ff4, "magic")
 
 # The vanilla drain spell is kinda weak to the point of near
 # unusability. This buffs its power to make it an interesting
@@ -118,6 +353,7 @@ def venom_virus_shadow_element(ff4):
 # tradeoff.
 def customize_drain_spell(ff4):
  ff4.DRAIN_SPELL.power = 13
+ mark_dirty(ff4, "magic")
  
 # The vanilla Dispel is reflectable, which makes it kind of hard for
 # it to remove Reflect the way it should. This makes it so it has some
@@ -125,6 +361,7 @@ def customize_drain_spell(ff4):
 def customize_dispel_spell(ff4):
  ff4.DISPL_SPELL.reflectable = False
  ff4.DISPL_SPELL.hitsboss = True
+ mark_dirty(ff4, "magic")
 
 # Sight is useless when you know the map by heart, but maybe it can be
 # be usable as a "Basuna" type spell that heals temporary statuses.
@@ -139,11 +376,13 @@ def customize_sight_spell(ff4):
  ff4.SIGHT_SPELL.visual1 = ff4.HEAL_SPELL.visual1
  ff4.SIGHT_SPELL.visual2 = ff4.HEAL_SPELL.visual2
  ff4.SIGHT_SPELL.sound = ff4.HEAL_SPELL.sound
+ mark_dirty(ff4, "magic")
 
 # I don't see any reason why Peep/Scan shouldn't work on bosses.
 # Not sure if that makes it useful per se, but it can't make it worse.
 def customize_peep_spell(ff4):
  ff4.PEEP_SPELL.hitsboss = True
+ mark_dirty(ff4, "magic")
 
 # In vanilla, "Stone" only costs 15 MP, which despite being pretty much
 # better than the Fatal/Death spell in every way (faster, can work on
@@ -152,6 +391,7 @@ def customize_peep_spell(ff4):
 # costs of other insta-kill spells.
 def customize_stone_spell(ff4):
  ff4.STONE_SPELL.mp = 45
+ mark_dirty(ff4, "magic")
 
 # This is basically a shortcut to apply all the spell customizations in
 # a single function call.
@@ -265,6 +505,7 @@ def customize_spellbooks(ff4):
  ff4.RYDIA_WHITE.teach_spell(36, ff4.BLINK_SPELL)
  ff4.RYDIA_WHITE.teach_spell(42, ff4.CURE3_SPELL)
  ff4.RYDIA_WHITE.teach_spell(48, ff4.WALL_SPELL)
+ mark_dirty(ff4, "magic")
 
 # This is just a straight up ASM hack that puts -Sort- and Trashcan at
 # the top of the inventory list (WHERE THEY BELONG! :P).
@@ -393,6 +634,11 @@ def rename_equipment(ff4):
   ff4.EAGLEEYE:      "#DwarfBun"
  }
  
+ # The item positions are looked up once instead of searching the item
+ # list for each rename.
+ positions = {id(item): index for index, item in enumerate(ff4.items)}
+ armors = ff4.rom.ARMORS_START_INDEX
+
  # Rename the items.
  for item, newname in renames.items():
 
@@ -406,8 +652,7 @@ def rename_equipment(ff4):
 
   # If it's an armor, the right-aligned part is the last two tokens
   # instead of just the last one.
-  index = ff4.items.index(item)
-  armors = ff4.rom.ARMORS_START_INDEX
+  index = positions[id(item)]
   if index in range(armors, armors + ff4.rom.TOTAL_ARMORS):
    addendum = ff4.text.ff4text(tokens[len(tokens) - 2].strip() + " ")
    rightpart = addendum + rightpart
@@ -431,6 +676,7 @@ def rename_equipment(ff4):
   # Now that we're done fixing the description, it's safe to rename the
   # actual item itself.
   item.name = newname
+ mark_dirty(ff4, "gear")
 
 # Give DK Cecil some equipment.
 def dk_equips_tank_gear(ff4):
@@ -446,6 +692,7 @@ def dk_equips_tank_gear(ff4):
  ff4.equips[0x05].flags[0] = True
  ff4.equips[0x06].flags[0] = True
  ff4.equips[0x07].flags[0] = True
+ mark_dirty(ff4, "gear")
 
 # Allow Porom to use hammers.
 def porom_uses_hammers(ff4):
@@ -485,6 +732,7 @@ def porom_uses_hammers(ff4):
    
    # And since we've determined it's a hammer, update its equip index.
    ff4.DUMMYSWORD.equips = unused
+ mark_dirty(ff4, "gear")
 
 # There's no reason Cid should be able to use bows IMO.
 # Pure speculation, but I suspect it was only only that way in vanilla
@@ -492,6 +740,7 @@ def porom_uses_hammers(ff4):
 # wooden hammer.
 def cid_no_bows(ff4):
  ff4.equips[ff4.SHORTBOW.equips].flags[10] = False
+ mark_dirty(ff4, "gear")
 
 def customize_equips(ff4):
  dk_equips_tank_gear(ff4)
@@ -555,6 +804,7 @@ def create_fairy_harp(ff4):
  line = ff4.POISONAXE.description[1].replace("Two-handed.", "")
  line = line.lstrip().ljust(27)
  ff4.POISONAXE.description[1] = line
+ mark_dirty(ff4, "gear")
 
 def create_sledge_hammer(ff4):
  ff4.SLEDGEHAMMER = ff4.DRAINSPEAR
@@ -583,11 +833,13 @@ def create_sledge_hammer(ff4):
  line = line.lstrip().ljust(27)
  ff4.RUNEAXE.description[1] = line
  ff4.items[0x29], ff4.items[0x48] = ff4.items[0x48], ff4.items[0x29]
+ mark_dirty(ff4, "gear")
 
 # For the lulz and the funzies, let's change the Strength Ring to the
 # Fabul Gauntlet.
 def create_fabul_gauntlet(ff4):
  ff4.STRENGTHRING.name = "[GLV]Fabul"
+ mark_dirty(ff4, "gear")
 
 # Normally the Mythril Staff casts Dispel, but if you use the Dispel
 # spell customizatiotn, it is now un-reflectable and able to hit bosses
@@ -597,6 +849,7 @@ def remove_dispel_from_staff(ff4):
  ff4.SILVERSTAFF.casts_spell = 0
  updated = ff4.SILVERSTAFF.description[1].replace("Casts [WHT]Dspel.", "")
  ff4.SILVERSTAFF.description[1] = updated
+ mark_dirty(ff4, "gear")
 
 # Normally the Ogrekiller and Poison/Venom Axe both hurt giants.
 # This seems a bit redundant to me, especially when combined with the
@@ -607,6 +860,7 @@ def customize_venom_axe(ff4):
  ff4.POISONAXE.races.flags[ff4.config.race_names.index("Slime")] = True
  updated = ff4.POISONAXE.description[3].replace("giants", "slimes")
  ff4.POISONAXE.description[3] = updated
+ mark_dirty(ff4, "gear")
  
 # I feel like the black shirt should give more WIS than the
 # Sorcerer/Lords robe at the very least.
@@ -615,6 +869,7 @@ def customize_black_shirt(ff4):
  # Here I'm trying WIS +10
  ff4.BLACKROBE.statbuff.amount = 2
  ff4.BLACKROBE.description[2] = "WIS+10."
+ mark_dirty(ff4, "gear")
 
 # The wizard robe seems like something that should boost both WIS and
 # WIL, so let's replace WIL +5 with WIS/WIL +3.
@@ -622,6 +877,7 @@ def customize_wizard_robe(ff4):
  ff4.WIZARDROBE.statbuff.stats = [False, False, False, True, True]
  ff4.WIZARDROBE.statbuff.amount = 0
  ff4.WIZARDROBE.description[2] = "WIS+3, WIL+3."
+ mark_dirty(ff4, "gear")
  
 # I feel like the crystal equipment should give a bigger WIL bonus than
 # the paladin equipment.
@@ -635,11 +891,13 @@ def customize_crystal_gear(ff4):
  updated = ff4.CRYSTALMAIL.description[1].replace("+3", "+5")
  ff4.CRYSTALMAIL.description[1] = updated
  ff4.CRYSTALGLOVE.description[1] = "WIL+5."
+ mark_dirty(ff4, "gear")
 
 # Gaia Gear seems less like it should be a robe for wizards and more like a "vest" 
 # type item.
 def customize_gaia_gear(ff4):
  ff4.GAEAROBE.equips = ff4.KARATEROBE.equips
+ mark_dirty(ff4, "gear")
 
 def customize_equipment(ff4):
  create_fairy_harp(ff4)
@@ -692,7 +950,7 @@ def customize_recall(ff4):
 # create this patch and thus have no idea how to fix it. I still feel
 # like it's a huge boost to Edward though, even with that bug.
 def customize_heal(ff4, patchpath):
- ff4.rom.apply_patch(patchpath + "Custom Salve.ips", "unheadered")
+ ips.load_patch(patchpath + "Custom Salve.ips", "unheadered").apply(ff4.rom.data)
 
 # Change Bear into Rage (self-berserk) and give it to Cid.
 # Only does this if J-commands are enabled.
@@ -747,6 +1005,10 @@ def customize_bear(ff4):
   ff4.rom.data[bearmessage] = 50
   # print("{}".format(bearmessage))
 
+  # Command names are written with the combat data, while the
+  # characters' command lists are part of the party data.
+  mark_dirty(ff4, "magic", "party", "combat")
+
 # Change Ninja (magic) into Sing and give it to Edward instead of Edge.
 def customize_ninja(ff4):
  
@@ -894,9 +1156,10 @@ def customize_ninja(ff4):
  # bytes = ff4.text.to_bytes(menu_name)
  # address = 0xB405 
  # ff4.rom.inject(address, bytes)
+ mark_dirty(ff4, "magic", "party", "combat")
 
 def customize_dark_wave(ff4, patchpath):
- ff4.rom.apply_patch(patchpath + "Dark Wave Fix.ips", "unheadered")
+ ips.load_patch(patchpath + "Dark Wave Fix.ips", "unheadered").apply(ff4.rom.data)
 
 # This is just a shortcut to apply all the command customizations in
 # one function call.
@@ -913,6 +1176,7 @@ def customize_commands(ff4, patchpath):
 def fix_yang_hp(ff4):
  for index in range(60, 70):
   ff4.YANG.levelups[index].hp = 152
+ mark_dirty(ff4, "party")
 
 # This will give Tellah some better levelup stats as well as some
 # better HP and even some MP.
@@ -942,6 +1206,7 @@ def improve_tellah_levels(ff4):
 
  # Except after level 70 where his MP goes up by 30 every level :O
  ff4.TELLAH.levelups[69].mp = 30
+ mark_dirty(ff4, "party")
 
 # Give DK Cecil some better HP progression.
 # It doesn't have to compete with the Paladin but it should at least
@@ -952,6 +1217,7 @@ def improve_dk_levels(ff4):
  for index, levelup in enumerate(ff4.DKCECIL.levelups):
   if index >= ff4.DKCECIL.level:
    levelup.hp = int((index - ff4.DKCECIL.level) / 6) * 10 + 20
+ mark_dirty(ff4, "party")
 
 # This is simply a shortcut to apply all the levelup customizations in
 # a single function call.
@@ -1078,6 +1344,9 @@ def consistent_starting_levels(ff4):
  ff4.FUSOYA1.equipped[3] = 0x8E
  ff4.FUSOYA1.equipped[4] = 0xA8
 
+ # The starting spells are part of the spellbooks.
+ mark_dirty(ff4, "party", "magic")
+
 # Makes the sealed cave exitable from everywhere but crystal room and
 # evil wall room. You shouldn't be able to skip the boss fight just by
 # casting Exit, but there's no need to prevent people from skipping a
@@ -1087,6 +1356,7 @@ def exit_sealed_cave(ff4):
  for index in sealed_cave_rooms:
   ff4.maps[index].exitable = True
   ff4.maps[index].warpable = True
+ mark_dirty(ff4, "maps")
 
 # Makes Mount Ordeals exitable. I don't think that leads to any abuses
 # and I'm really not sure why it wasn't exitable to begin with. I get
@@ -1096,31 +1366,35 @@ def exit_mount_ordeals(ff4):
  mount_ordeals_rooms = list(range(132, 136))
  for index in mount_ordeals_rooms:
   ff4.maps[index].exitable = True
+ mark_dirty(ff4, "maps")
 
 # This applies an IPS patch that makes it so that the black chocobo no
 # longer automatically goes home when you remount it.
 def black_chocobo_fix(ff4, patchpath):
- ff4.rom.apply_patch(patchpath + "Black Chocobo Fix.ips", "headered")
+ ips.load_patch(patchpath + "Black Chocobo Fix.ips", "headered").apply(ff4.rom.data)
 
 # This allows you to land next to Kaipo instead of having to walk all
 # that way across the desert.
 def kaipo_landing_tile(ff4):
 
- # Put a grass tile next to Kaipo town.
- ff4.overworld.tiles[104][124] = 0x16
+ with grid.TileGrid(ff4.overworld.tiles) as overworld:
+
+  # Put a grass tile next to Kaipo town.
+  overworld[124, 104] = 0x16
 
- # Cosmetic adjustments to make it look more natural.
- ff4.overworld.tiles[104][123] = 0x34
- ff4.overworld.tiles[105][123] = 0x11
- ff4.overworld.tiles[105][124] = 0x33
+  # Cosmetic adjustments to make it look more natural.
+  overworld[123, 104] = 0x34
+  overworld[123, 105] = 0x11
+  overworld[124, 105] = 0x33
+ mark_dirty(ff4, "overworld")
  
  # And as a QOL thing let's make all Kaipo's exits put us on that tile.
- for trigger in ff4.KAIPO_TOWN.triggers:
-  if trigger.type == "teleport":
-   if trigger.map == 0xFB:
-    trigger.new_x = 124
-    trigger.new_y = 104
-    # print(ff4.display(trigger))
+ for trigger in trigger_table(ff4).of_type(ff4.KAIPO_TOWN, "teleport"):
+  if trigger.map == 0xFB:
+   trigger.new_x = 124
+   trigger.new_y = 104
+   mark_triggers(ff4, [trigger])
+   # print(ff4.display(trigger))
 
 # This is simply a shortcut to apply all the map related customizations
 # in a single function call.
@@ -1137,6 +1411,7 @@ def customize_maps(ff4, patchpath):
 def pale_dim_weakness(ff4):
  ff4.PALE_DIM.add_weakness("Shadow")
  ff4.PALE_DIM.add_resistance("Holy")
+ mark_dirty(ff4, "combat")
 
 # Despite its name, the Mist Dragon is not actually a Dragon. This
 # wouldn't have mattered in the vanilla game but it does matter in
@@ -1147,10 +1422,12 @@ def customize_mist_dragon(ff4):
  # It also seems like a holy element dragon, so let's make it weak to
  # Shadow while we're at it.
  ff4.D_MIST.add_weakness("Shadow")
+ mark_dirty(ff4, "combat")
 
 # Bahamut definitely should have the "Dragon" flag.
 def bahamut_dragon(ff4):
  ff4.BAHAMUT.add_race("Dragon")
+ mark_dirty(ff4, "combat")
 
 # This makes it so that the monsters that seem like golems or other
 # normally inanimate objects that have been somehow animated or made
@@ -1201,6 +1478,7 @@ def customize_constructs(ff4):
   # monster.has_races = True
   # construct_race = ff4.config.race_names.index("Machine")
   # monster.races.flags[construct_race] = True
+ mark_dirty(ff4, "combat")
 
 # A number of monsters in vanilla seem like they should be floating,
 # yet do not actually float. Even if they display the "bobbing up and
@@ -1273,6 +1551,7 @@ def customize_floating(ff4):
   # monster.has_weaknesses = True
   # air_element = ff4.config.element_names.index("Air")
   # monster.weaknesses.flags[air_element] = True
+ mark_dirty(ff4, "combat")
 
 
 # Changing the monster data like this is what makes it so that this
@@ -1298,71 +1577,16 @@ def customize_monsters(ff4):
 # too rare. So my solution is to play with J items on but then convert
 # all J items in chests to standard things like remedies or phoenix
 # downs or whatever.
-def convert_jitems(ff4):
-
- # Which items we convert to depends on the tier of the item being
- # converted. The summon orbs aren't coverted.
- tier2 = [
-  ff4.THORRAGE,
-  ff4.HERMES,
-  ff4.STARVEIL,
-  ff4.MUTEBELL,
-  ff4.UNIHORN,
-  ff4.LIFE,
-  ff4.TENT,
-  ff4.EXIT
- ]
- 
- tier3 = [
-  ff4.SUCCUBUS,
-  ff4.SILKWEB,
-  ff4.KAMIKAZE,
-  ff4.CURE2,
-  ff4.ETHER1,
-  ff4.HEAL
- ]
- 
- tier4 = [
-  ff4.BIGBOMB,
-  ff4.BOREAS,
-  ff4.ZEUSRAGE,
-  ff4.STARDUST,
-  ff4.VAMPIRE,
-  ff4.ILLUSION,
-  ff4.FIREBOMB,
-  ff4.BLIZZARD,
-  ff4.LITBOLT,
-  ff4.GAIADRUM,
-  ff4.GRIMOIRE,
-  ff4.CURE3,
-  ff4.ETHER2,
-  ff4.SOMADROP,
-  ff4.CABIN
- ]
- 
- tier5 = [
-  ff4.BACCHUS,
-  ff4.HRGLASS2,
-  ff4.COFFIN,
-  ff4.ELIXIR,
-  ff4.SIREN
- ]
- 
- tier6 = [
-  ff4.AUAPPLE,
-  ff4.AGAPPLE
- ]
- 
- tier7 = [
-  ff4.MOONVEIL
- ]
- 
+def convert_jitems(ff4, tiers = None):
+ if tiers is None:
+  tiers = JITEM_TIERS
+
+ # Rather than checking every chest's item against each tier list, the
+ # tiers are compiled once into a table indexed by item number.
+ table = compile_jitem_table(ff4, tiers)
+
  # Now we loop through all the treasure triggers and convert all
- # items of each tier to their corresponding supplies. If there are
- # multiple possible items to covert to, we use the parity (odd/even)
- # of the item index to decide which one. I could randomize it, but
- # doing it this way ensures that the same seed will always produce
- # the same output rom, even when patched with this utility.
+ # items of each tier to their corresponding supplies.
  changed_treasures = []
  for index, map in enumerate(ff4.maps):
   for trigger in map.triggers:
@@ -1373,36 +1597,58 @@ def convert_jitems(ff4):
       # print(trigger.display(ff4))
       # trigger.trapped = False
     if not trigger.has_money:
-     item = ff4.items[trigger.contents]
-     even = trigger.contents % 2
-     changed = True
-     if item in tier2:
-      if even:
-       trigger.contents = ff4.items.index(ff4.LIFE)
-      else:
-       trigger.contents = ff4.items.index(ff4.TENT)
-     elif item in tier3:
-      if even:
-       trigger.contents = ff4.items.index(ff4.CABIN)
-      else:
-       trigger.contents = ff4.items.index(ff4.ETHER1)
-     elif item in tier4:
-      if even:
-       trigger.contents = ff4.items.index(ff4.CURE2)
-      else:
-       trigger.contents = ff4.items.index(ff4.HEAL)
-     elif item in tier5:
-      trigger.contents = ff4.items.index(ff4.CURE3)
-     elif item in tier6:
-      trigger.contents = ff4.items.index(ff4.ETHER2)
-     elif item in tier7:
-      trigger.contents = ff4.items.index(ff4.ELIXIR)
-     else:
-      changed = False
-     if changed:
+     replacement = table[trigger.contents]
+     if replacement is not None:
+      trigger.contents = replacement
       changed_treasures.append(trigger)
+ mark_triggers(ff4, changed_treasures)
  return changed_treasures
 
+# Which items we convert to depends on the tier of the item being
+# converted. The summon orbs aren't coverted. Each entry is a list of
+# the items in a tier followed by what they turn into, all named by
+# their constant names so that a custom table can be loaded from a
+# file (see load_jitem_tiers).
+# If there are multiple possible items to covert to, we use the parity
+# (odd/even) of the item index to decide which one. I could randomize
+# it, but doing it this way ensures that the same seed will always
+# produce the same output rom, even when patched with this utility.
+JITEM_TIERS = [
+ (["THORRAGE", "HERMES", "STARVEIL", "MUTEBELL", "UNIHORN", "LIFE", "TENT", "EXIT"],
+  ["TENT", "LIFE"]),
+ (["SUCCUBUS", "SILKWEB", "KAMIKAZE", "CURE2", "ETHER1", "HEAL"],
+  ["ETHER1", "CABIN"]),
+ (["BIGBOMB", "BOREAS", "ZEUSRAGE", "STARDUST", "VAMPIRE", "ILLUSION", "FIREBOMB", "BLIZZARD",
+   "LITBOLT", "GAIADRUM", "GRIMOIRE", "CURE3", "ETHER2", "SOMADROP", "CABIN"],
+  ["HEAL", "CURE2"]),
+ (["BACCHUS", "HRGLASS2", "COFFIN", "ELIXIR", "SIREN"],
+  ["CURE3"]),
+ (["AUAPPLE", "AGAPPLE"],
+  ["ETHER2"]),
+ (["MOONVEIL"],
+  ["ELIXIR"])
+]
+
+# Compiles a tier table into a 256 entry list that maps each item index
+# to the index of the item it converts to (or None if it's left alone).
+# If an item is listed in more than one tier, the first one wins.
+def compile_jitem_table(ff4, tiers):
+ positions = {id(item): index for index, item in enumerate(ff4.items)}
+ table = [None] * 256
+ for items, replacements in tiers:
+  targets = [positions[id(getattr(ff4, name))] for name in replacements]
+  for name in items:
+   index = positions[id(getattr(ff4, name))]
+   if table[index] is None:
+    table[index] = targets[index % len(targets)]
+ return table
+
+# Loads a custom tier table from a JSON file laid out the same way as
+# JITEM_TIERS, i.e. a list of [[items...], [replacements...]] pairs.
+def load_jitem_tiers(filename):
+ with open(filename) as file:
+  return [(items, replacements) for items, replacements in json.load(file)]
+
 class Chest:
  def __init__(self, x = 0, y = 0, trigger = None):
   self.x = x
@@ -1411,67 +1657,78 @@ class Chest:
 
 # Prints a tilemap to the console (for debugging purposes).
 def print_tilemap(ff4, map):
- for y in range(32):
-  line = ""
-  for x in range(32):
-   line += "{:02X} ".format(map.tiles[y][x])
-  print(line)
+ print(grid.TileGrid(map.tiles))
 
 # Fills a rectangle with the given tile.
 # Starts at the given (x, y) position and fills a (w by h) rectangle
 # including both endpoints.
 # (Used in map procgen)
 def fill_box(ff4, map, x, y, w, h, tile):
- for row in range(y, y + h):
-  for col in range(x, x + w):
-   map.tiles[row][col] = tile
+ with grid.TileGrid(map.tiles) as tiles:
+  tiles.fill(x, y, w, h, tile)
 
 # Scans the given map for chest tiles and returns an array of Chest
 # objects with those locations and their corresponding triggers from
 # the map's trigger list.
 def scan_for_chests(ff4, map, chesttile):
  tilemap = ff4.tilemaps[map.tilemap]
- chests = []
- for y in range(32):
-  for x in range(32):
-   if tilemap.tiles[y][x] == chesttile:
-    chest = Chest(x, y)
-    for trigger in map.triggers:
-     if trigger.x == chest.x and trigger.y == chest.y:
-      chest.trigger = trigger
-      break
-    chests.append(chest)
- return chests
+ table = trigger_table(ff4)
+ return [Chest(x, y, table.at(map, x, y)) for x, y in grid.TileGrid(tilemap.tiles).find(chesttile)]
 
 # Erases all chest tiles from the given tilemap.
 # Make sure the list of chests and corresponding triggers has been
 # constructed prior to calling this or the information will be lost.
 # The chest tiles are replaced with the given alternative tile.
 def erase_all_chests(ff4, tilemap, chests, alternative):
- for chest in chests:
-  tilemap.tiles[chest.y][chest.x] == alternative 
-
-# Replaces a tilemap with a procedurally generated one.
-# For now it just affects Antlion Cave B1 but eventually the map will
-# be passed as a parameter.
-def procgen(ff4):
- map = ff4.ANTLION_CAVE_1F
+ with grid.TileGrid(tilemap.tiles) as tiles:
+  for chest in chests:
+   tiles[chest.x, chest.y] = alternative
+
+# The tiles procgen builds Antlion Cave style dungeons out of.
+CAVE_TILES = {
+ "wall": 0x6E,
+ "floor": 0x36,
+ "rock": 0x7E,
+ "chest": 0x78
+}
+
+# Replaces a map's tilemap with a procedurally generated one (see
+# dungeon.py) and returns the list of chests in their new spots. It
+# defaults to Antlion Cave B1 but any map can be passed in, along with
+# the tiles to build it from.
+# The chests keep their triggers (and so their contents), which get
+# moved along with them. Every other trigger keeps its spot and its
+# tile, and the layout is built around them.
+# If "candidates" is more than one, that many layouts are generated
+# (spread over "workers" processes) and the best scoring one is kept.
+# The result still only depends on the seed.
+# If no seed is given, it's taken from the rom itself, so that (like the
+# rest of Voyager) the same input rom always gives the same output.
+# Bear in mind that a tilemap can be shared by more than one map.
+def procgen(ff4, map = None, seed = None, tiles = CAVE_TILES, candidates = 1, workers = None):
+ if map is None:
+  map = ff4.ANTLION_CAVE_1F
+ if seed is None:
+  seed = cache.rom_hash(bytes(ff4.rom.data))
  tilemap = ff4.tilemaps[map.tilemap]
- #print_tilemap(ff4, tilemap)
- abysstile = 0x6E
- floortile = 0x36
- rocktile = 0x7E
- chesttile = 0x78
- chests = scan_for_chests(ff4, map, chesttile)
- erase_all_chests(ff4, tilemap, chests, rocktile)
- # To-do:
- # * Make a Chest object that encodes a chest location and trigger
- # * Scan the tilemap, making a list of existing chest locations
- # * Scan the map's trigger list and set each chest's trigger index
- # * Erase all the chests from the tilemap
- # - Place an equivalent number of new chests
- # - Update the corresponding triggers to have the (x, y) of new chests
- 
- # map.tiles[4][10] = rocktile
- # fill_box(ff4, map, 0, 0, 32, 32, abysstile)
- # fill_box(ff4, map, 1, 1, 30, 30, floortile)
+ chests = scan_for_chests(ff4, map, tiles["chest"])
+ positions = set((chest.x, chest.y) for chest in chests)
+ with grid.TileGrid(tilemap.tiles) as tilegrid:
+  anchors = {}
+  for trigger in map.triggers:
+   if (trigger.x, trigger.y) not in positions:
+    anchors[(trigger.x, trigger.y)] = tilegrid[trigger.x, trigger.y]
+  if candidates > 1:
+   layout = dungeon.search(tilegrid.array.shape, seed, candidates, len(chests), anchors, tiles, workers)
+  else:
+   layout = dungeon.generate(tilegrid.array.shape, seed, len(chests), anchors, tiles)
+  tilegrid.array[:] = layout.tiles
+ for chest, (x, y) in zip(chests, layout.chests):
+  chest.x = x
+  chest.y = y
+  if chest.trigger is not None:
+   chest.trigger.x = x
+   chest.trigger.y = y
+ mark_triggers(ff4, [chest.trigger for chest in chests if chest.trigger is not None])
+ mark_dirty(ff4, "tilemaps")
+ return chests